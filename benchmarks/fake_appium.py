@@ -0,0 +1,103 @@
+import os
+import re
+import json
+import uuid
+import base64
+import logging
+import threading
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw
+
+def synthetic_screens(count=4, size=(1080, 2340)):
+    # the same labelled blocks under a header that changes with every screen, like an app moving between pages
+    screens = []
+    for index in range(count):
+        image = Image.new("RGB", size, (245, 245, 245))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, size[0], 180), fill=(40 + 50 * index % 200, 90, 160))
+        for row in range(6):
+            top = 300 + row * 300
+            draw.rectangle((80, top, size[0] - 80, top + 200), fill=(255, 255, 255), outline=(200, 200, 200), width=4)
+            draw.text((120, top + 80), f"item {row}", fill=(20, 20, 20))
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        screens.append(buffer.getvalue())
+    return screens
+
+def load_screens(path):
+    return [open(os.path.join(path, name), "rb").read() for name in sorted(os.listdir(path)) if name.lower().endswith(".png")]
+
+# a stand-in appium server, it serves recorded screenshots and moves to the next one after every gesture
+class FakeAppium:
+    def __init__(self, screens, page_source="<hierarchy/>", width=1080, height=2340):
+        self.screens = screens
+        self.page_source = page_source
+        self.width = width
+        self.height = height
+        self.bytes_sent = 0
+        self.requests = 0
+        self._screen = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def reset_counters(self):
+        with self._lock:
+            self.bytes_sent = 0
+            self.requests = 0
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-appium", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, body):
+        # returns the w3c "value" of a command
+        with self._lock:
+            self.requests += 1
+            if method == "POST" and path == "/session":
+                return {"sessionId": uuid.uuid4().hex, "capabilities": {"platformName": "Android", "automationName": "UiAutomator2"}}
+            command = re.sub(r"^/session/[^/]+", "", path)
+            if command == "/window/rect":
+                return {"x": 0, "y": 0, "width": self.width, "height": self.height}
+            if command == "/screenshot":
+                return base64.b64encode(self.screens[self._screen % len(self.screens)]).decode("utf-8")
+            if command == "/source":
+                return self.page_source
+            if command == "/actions":
+                self._screen += 1
+                return None
+            if command == "/appium/stop_recording_screen":
+                return ""
+            return None
+
+def _handler(appium: FakeAppium):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length)) if length else None
+            value = appium.handle(self.command, self.path, body)
+            data = json.dumps({"value": value}).encode("utf-8")
+            with appium._lock:
+                appium.bytes_sent += len(data)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _reply
+        do_POST = _reply
+        do_DELETE = _reply
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
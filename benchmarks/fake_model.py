@@ -0,0 +1,64 @@
+import json
+import time
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from models.locate import LOCATE_PROMPT
+
+# a stand-in /v1/chat/completions host, it answers after a configurable latency and counts the bytes it receives
+class FakeModel:
+    def __init__(self, latency=0.3, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def reset_counters(self):
+        with self._lock:
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.requests = 0
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-model", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def complete(self, payload):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        prompt = payload["messages"][0]["content"][0]["text"]
+        # a fixed point on the label of a block of the synthetic screens keeps every run the same
+        content = "[0.12, 0.42]" if prompt == LOCATE_PROMPT else "found"
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}
+
+def _handler(model: FakeModel):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            data = json.dumps(model.complete(json.loads(body))).encode("utf-8")
+            with model._lock:
+                model.requests += 1
+                model.bytes_received += length
+                model.bytes_sent += len(data)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
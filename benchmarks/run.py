@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import yaml
+import shutil
+import logging
+import argparse
+import tempfile
+from core import engine
+from benchmarks.fake_appium import FakeAppium, synthetic_screens, load_screens
+from benchmarks.fake_model import FakeModel
+
+ELEMENTS = [f"item {row}" for row in range(6)]
+# config overrides of every backend, on top of config.yml
+BACKENDS = {
+    "remote": {"hierarchy-enabled": False},
+    "remote-png": {"hierarchy-enabled": False, "remote-image-format": "png", "remote-image-max-side": 0},
+    "hierarchy": {"hierarchy-enabled": True},
+    "cache": {"hierarchy-enabled": False, "locate-cache-enabled": True},
+    "template": {"hierarchy-enabled": False, "template-enabled": True},
+    "replay": {"hierarchy-enabled": False, "replay-enabled": True},
+    "async": {"hierarchy-enabled": False, "async-enabled": True},
+    "local": {"hierarchy-enabled": False, "locate-model-type": "local", "validate-model-type": "local"},
+}
+DEFAULT_BACKENDS = ["remote", "remote-png", "hierarchy", "cache", "template", "replay", "async"]
+PHASES = ["locate", "locate.model", "validate", "act", "client.take_screenshot", "client.wait_for_settle", "transport.chat_completions"]
+
+def page_source(width, height):
+    # the labelled blocks of the synthetic screens, found by the hierarchy backend without any model request
+    nodes = [f'<node text="{element}" bounds="[80,{300 + row * 300}][{width - 80},{500 + row * 300}]" displayed="true"/>' for row, element in enumerate(ELEMENTS)]
+    return f'<hierarchy>{"".join(nodes)}</hierarchy>'
+
+def case_file(cases):
+    steps = [
+        {"element": ELEMENTS[1], "action": "click", "validation": ELEMENTS[2]},
+        {"element": ELEMENTS[2], "action": "input", "text": "benchmark", "validation": ELEMENTS[3]},
+        {"from_element": ELEMENTS[4], "to_element": ELEMENTS[0], "action": "swipe", "validation": ELEMENTS[1]},
+        {"element": ELEMENTS[5], "action": "click"},
+    ]
+    # the cases are the same, so that replay finds the steps recorded by the first one
+    return {"cases": [{"case": {"name": "benchmark", "steps": steps}} for _ in range(cases)]}, len(steps)
+
+def run_backend(name, args, appium_host, model_host, work_path):
+    run_path = os.path.join(work_path, name)
+    os.makedirs(os.path.join(run_path, "cases"), exist_ok=True)
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yml"), "r", encoding="utf-8") as f:
+        conf = yaml.safe_load(f)
+    conf.pop("devices", None)
+    conf.update({
+        "appium-server-host": appium_host,
+        "locate-model-type": "remote",
+        "locate-model-host": model_host,
+        "validate-model-type": "remote",
+        "validate-model-host": model_host,
+        "device-type": "android",
+        "settle-interval": args.settle_interval,
+        "trace-enabled": True,
+    })
+    conf.update(BACKENDS[name])
+    with open(os.path.join(run_path, "config.yml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(conf, f, allow_unicode=True)
+
+    cases, steps_per_case = case_file(args.cases)
+    for index in range(args.files):
+        with open(os.path.join(run_path, "cases", f"test_benchmark_{index}.yml"), "w", encoding="utf-8") as f:
+            yaml.safe_dump(cases, f, allow_unicode=True)
+
+    # the engine reads its options from the command line
+    argv = sys.argv
+    sys.argv = ["aitest", "--config-file", os.path.join(run_path, "config.yml"), "--case-path", os.path.join(run_path, "cases")]
+    try:
+        engine.Engine(run_path).start()
+    finally:
+        sys.argv = argv
+
+    with open(os.path.join(run_path, "records/summary.json"), "r", encoding="utf-8") as f:
+        summary = json.load(f)
+    steps = summary["passed"] * steps_per_case
+    return {
+        "cases": summary["total"],
+        "failed": summary["failed"],
+        "steps": steps,
+        "duration": summary["duration"],
+        "steps_per_sec": round(steps / summary["duration"], 3) if summary["duration"] else 0.0,
+        "phases": {phase: summary["phases"][phase] for phase in PHASES if phase in summary["phases"]},
+    }
+
+def compare(results, baseline, tolerance):
+    # a backend regresses when its throughput drops by more than the tolerance
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["steps_per_sec"], result["steps_per_sec"]
+        change = (after - before) / before if before else 0.0
+        print(f"{name}: {before:.3f} -> {after:.3f} steps/sec ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+def report(results):
+    print(f"{'backend':<12}{'steps/s':>9}{'steps':>7}{'failed':>8}{'locate p50/p95':>18}{'validate p50/p95':>20}{'appium KB':>11}{'model KB':>10}{'requests':>10}")
+    for name, result in results.items():
+        phases = result["phases"]
+        locate = phases.get("locate", {"p50": 0, "p95": 0})
+        validate = phases.get("validate", {"p50": 0, "p95": 0})
+        print(f"{name:<12}{result['steps_per_sec']:>9.3f}{result['steps']:>7}{result['failed']:>8}"
+              f"{locate['p50']:>9.3f}/{locate['p95']:<8.3f}{validate['p50']:>10.3f}/{validate['p95']:<9.3f}"
+              f"{result['appium_bytes'] / 1024:>11.0f}{result['model_bytes'] / 1024:>10.0f}{result['model_requests']:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark of the engine against a stand-in appium server and model host', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--backends', type=str, default=",".join(DEFAULT_BACKENDS), metavar='', help=f'\nComma separated backends, support: {", ".join(BACKENDS)}, default: {",".join(DEFAULT_BACKENDS)}')
+    parser.add_argument('--screenshots', type=str, metavar='', help='\nDirectory of recorded png screenshots, default: synthetic screens')
+    parser.add_argument('--files', type=int, default=2, metavar='', help='\nCase files per backend, default: 2')
+    parser.add_argument('--cases', type=int, default=3, metavar='', help='\nCases per file, default: 3')
+    parser.add_argument('--latency', type=float, default=0.3, metavar='', help='\nSeconds of every model request, default: 0.3')
+    parser.add_argument('--jitter', type=float, default=0.0, metavar='', help='\nRandom seconds added to or removed from the latency, default: 0')
+    parser.add_argument('--settle-interval', type=float, default=0.05, metavar='', help='\nSeconds between two settle frames, default: 0.05')
+    parser.add_argument('--output', type=str, metavar='', help='\nSave the results as json')
+    parser.add_argument('--baseline', type=str, metavar='', help='\nResults json of an earlier run, exit with 1 if a backend is slower')
+    parser.add_argument('--tolerance', type=float, default=0.1, metavar='', help='\nAllowed drop of steps/sec against the baseline, default: 0.1')
+    parser.add_argument('--verbose', action='store_true', help='\nShow the engine logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s')
+    screens = load_screens(args.screenshots) if args.screenshots else synthetic_screens()
+    appium = FakeAppium(screens)
+    model = FakeModel(args.latency, args.jitter)
+    appium_host, model_host = appium.start(), model.start()
+    work_path = tempfile.mkdtemp(prefix="aitest-benchmark-")
+
+    results = {}
+    try:
+        for name in [name.strip() for name in args.backends.split(",") if name.strip()]:
+            if name not in BACKENDS:
+                raise Exception(f"backend is not supported: {name}, support: {', '.join(BACKENDS)}")
+            appium.page_source = page_source(appium.width, appium.height) if BACKENDS[name].get("hierarchy-enabled") else "<hierarchy/>"
+            appium.reset_counters()
+            model.reset_counters()
+            result = run_backend(name, args, appium_host, model_host, work_path)
+            result.update({"appium_bytes": appium.bytes_sent, "appium_requests": appium.requests,
+                           "model_bytes": model.bytes_received + model.bytes_sent, "model_requests": model.requests})
+            results[name] = result
+    finally:
+        appium.stop()
+        model.stop()
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"throughput regressed: {', '.join(regressions)}")
+            sys.exit(1)
@@ -14,18 +14,90 @@ def load_config(config_path):
     config = Config.from_yaml(config_data)
     return config
 
+@dataclass
+class DeviceConfig:
+    # tags the records of the device in the run manifest and its results in the summary, default is the udid
+    name: str
+    appium_server_host: str
+    udid: str
+    # uiautomator2 needs a unique system port for every parallel session on the same host
+    system_port: int
+
+    @classmethod
+    def from_yaml(cls, yaml_data: dict, appium_server_host: str = "") -> "DeviceConfig":
+        udid = yaml_data.get("udid", "")
+        return cls(
+            name=str(yaml_data.get("name", udid)),
+            appium_server_host=yaml_data.get("appium-server-host", appium_server_host),
+            udid=udid,
+            system_port=yaml_data.get("system-port", 0)
+        )
+
 @dataclass
 class Config:
     # appium server config
     appium_server_host: str
 
+    # multi-device config, case files are sharded across all devices
+    devices: list[DeviceConfig]
+
     # locate model config
     locate_model_type: Literal["local", "remote"]
     locate_model_host: str
+    # set locate and validate to the same repo to share one loaded model in local mode
+    locate_model_repo: str
+    # resolve elements from the appium page source before running the locate model
+    hierarchy_enabled: bool
+    hierarchy_threshold: float
+    # two stage local locate, a pass on the screen reduced to coarse max side, then a pass on a crop of crop ratio times the short side
+    locate_two_stage: bool
+    locate_coarse_max_side: int
+    locate_crop_ratio: float
+    # locate cache config, reuse locate results of near duplicate screenshots
+    locate_cache_enabled: bool
+    locate_cache_path: str
+    locate_cache_tolerance: int
+    locate_cache_max_entries: int
 
     # validate model config
     validate_model_type: Literal["local", "remote"]
     validate_model_host: str
+    validate_model_repo: str
+    # local validate mode, score runs one forward pass and compares "found" with "not found"
+    validate_mode: Literal["score", "generate"]
+    validate_threshold: float
+
+    # template config, crops of located elements are matched before running the locate model
+    template_enabled: bool
+    template_path: str
+    template_threshold: float
+    # side of the square crop, scaled from 0 to 1 of the screen width
+    template_size: float
+
+    # replay config, coordinates of passed cases are replayed when the screen matches
+    replay_enabled: bool
+    replay_path: str
+    replay_tolerance: int
+
+    # remote model request config, shared by the locate and validate hosts
+    model_request_timeout: float
+    model_request_retries: int
+    model_request_backoff: float
+    model_pool_size: int
+    # remote image config, screenshots are resized and compressed before they are sent
+    remote_image_max_side: int
+    remote_image_format: Literal["png", "jpeg", "webp"]
+    remote_image_quality: int
+    remote_image_grayscale: bool
+
+    # local model config, backend is one of fp32, bf16, int8; threads 0 keeps the torch default
+    local_model_backend: Literal["fp32", "bf16", "int8"]
+    local_model_threads: int
+    # workers > 0 runs local models in that many worker processes, a worker address connects to a pool started by models.workers
+    local_model_workers: int
+    local_model_worker_address: str
+    # seconds a locate or validate may take in a worker once it has loaded its models, 0 waits forever
+    local_model_worker_timeout: float
 
     # device config
     device_type: Literal["android", "ios"]
@@ -37,17 +109,94 @@ class Config:
     app_package: str
     app_activity: str
 
+    # screen settle config, poll full resolution screenshots until consecutive ones stop changing
+    # threshold is the mean gray level difference between two frames, scaled from 0 to 1
+    settle_threshold: float
+    settle_timeout: float
+    settle_interval: float
+    settle_stable_frames: int
+
+    # daemon config, the daemon listens on this local address and checks its device sessions every interval seconds
+    daemon_address: str
+    daemon_health_interval: float
+
+    # trace config, spans of the client and the models are aggregated into the summary and exported as a chrome trace
+    trace_enabled: bool
+    trace_path: str
+
+    # records config, images are stored once under the hash of their content, webp is lossless
+    # runs older than max age days are dropped, then the oldest runs until the records fit in max size, 0 is unlimited
+    records_image_format: Literal["webp", "png"]
+    records_max_size_mb: int
+    records_max_age_days: int
+
+    # async core config, the steps of all devices interleave as asyncio tasks of one event loop
+    # blocking calls run in an executor of that many threads, appium and model limits are calls in flight per host
+    async_enabled: bool
+    async_executor_workers: int
+    async_appium_concurrency: int
+    async_model_concurrency: int
+
     @classmethod
     def from_yaml(cls, yaml_data: dict) -> "Config":
         return cls(
             appium_server_host=yaml_data.get("appium-server-host", ""),
+            devices=[DeviceConfig.from_yaml(device, yaml_data.get("appium-server-host", "")) for device in yaml_data.get("devices") or []],
             locate_model_type=yaml_data.get("locate-model-type", "local"),
             locate_model_host=yaml_data.get("locate-model-host", ""),
+            locate_model_repo=yaml_data.get("locate-model-repo", "showlab/ShowUI-2B"),
+            hierarchy_enabled=yaml_data.get("hierarchy-enabled", True),
+            hierarchy_threshold=yaml_data.get("hierarchy-threshold", 0.85),
+            locate_two_stage=yaml_data.get("locate-two-stage", False),
+            locate_coarse_max_side=yaml_data.get("locate-coarse-max-side", 1024),
+            locate_crop_ratio=yaml_data.get("locate-crop-ratio", 0.5),
+            locate_cache_enabled=yaml_data.get("locate-cache-enabled", False),
+            locate_cache_path=yaml_data.get("locate-cache-path", "cache/locate.db"),
+            locate_cache_tolerance=yaml_data.get("locate-cache-tolerance", 4),
+            locate_cache_max_entries=yaml_data.get("locate-cache-max-entries", 1000),
             validate_model_type=yaml_data.get("validate-model-type", "local"),
             validate_model_host=yaml_data.get("validate-model-host", ""),
+            validate_model_repo=yaml_data.get("validate-model-repo", "Qwen/Qwen2-VL-2B-Instruct"),
+            validate_mode=yaml_data.get("validate-mode", "score"),
+            validate_threshold=yaml_data.get("validate-threshold", 0.5),
+            template_enabled=yaml_data.get("template-enabled", False),
+            template_path=yaml_data.get("template-path", "cache/templates"),
+            template_threshold=yaml_data.get("template-threshold", 0.9),
+            template_size=yaml_data.get("template-size", 0.12),
+            replay_enabled=yaml_data.get("replay-enabled", False),
+            replay_path=yaml_data.get("replay-path", "cache/replay.json"),
+            replay_tolerance=yaml_data.get("replay-tolerance", 2),
+            model_request_timeout=yaml_data.get("model-request-timeout", 60.0),
+            model_request_retries=yaml_data.get("model-request-retries", 3),
+            model_request_backoff=yaml_data.get("model-request-backoff", 0.5),
+            model_pool_size=yaml_data.get("model-pool-size", 10),
+            remote_image_max_side=yaml_data.get("remote-image-max-side", 1280),
+            remote_image_format=yaml_data.get("remote-image-format", "jpeg"),
+            remote_image_quality=yaml_data.get("remote-image-quality", 85),
+            remote_image_grayscale=yaml_data.get("remote-image-grayscale", False),
+            local_model_backend=yaml_data.get("local-model-backend", "fp32"),
+            local_model_threads=yaml_data.get("local-model-threads", 0),
+            local_model_workers=yaml_data.get("local-model-workers", 0),
+            local_model_worker_address=yaml_data.get("local-model-worker-address", ""),
+            local_model_worker_timeout=yaml_data.get("local-model-worker-timeout", 300.0),
             device_type=yaml_data.get("device-type", ""),
             device_width=yaml_data.get("device-width", 0),
             device_height=yaml_data.get("device-height", 0),
             app_package=yaml_data.get("app-package", ""),
-            app_activity=yaml_data.get("app-activity", "")
+            app_activity=yaml_data.get("app-activity", ""),
+            settle_threshold=yaml_data.get("settle-threshold", 0.005),
+            settle_timeout=yaml_data.get("settle-timeout", 5.0),
+            settle_interval=yaml_data.get("settle-interval", 0.2),
+            settle_stable_frames=yaml_data.get("settle-stable-frames", 1),
+            daemon_address=yaml_data.get("daemon-address", "127.0.0.1:6200"),
+            daemon_health_interval=yaml_data.get("daemon-health-interval", 60.0),
+            trace_enabled=yaml_data.get("trace-enabled", True),
+            trace_path=yaml_data.get("trace-path", "records/trace.json"),
+            records_image_format=yaml_data.get("records-image-format", "webp"),
+            records_max_size_mb=yaml_data.get("records-max-size-mb", 2048),
+            records_max_age_days=yaml_data.get("records-max-age-days", 30),
+            async_enabled=yaml_data.get("async-enabled", False),
+            async_executor_workers=yaml_data.get("async-executor-workers", 32),
+            async_appium_concurrency=yaml_data.get("async-appium-concurrency", 4),
+            async_model_concurrency=yaml_data.get("async-model-concurrency", 8)
         )
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import inspect
+import logging
+import functools
+import contextvars
+import plan
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from mobile.client import AsyncClient
+from models.locate import AsyncLocate
+from models.validate import AsyncValidate
+from models import transport
+
+# the executor of the blocking calls of one event loop, and its concurrency limits per resource
+class Runtime:
+    def __init__(self, max_workers, limits):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aio")
+        # resource kind -> calls in flight per key of that kind, e.g. "appium" -> 4 per appium server host
+        self._limits = limits
+        self._semaphores = {}
+
+    def limit(self, resource):
+        # resource is a (kind, key) pair, a kind without a limit is not limited
+        if resource is None or not self._limits.get(resource[0]):
+            return nullcontext()
+        semaphore = self._semaphores.get(resource)
+        if semaphore is None:
+            semaphore = self._semaphores[resource] = asyncio.Semaphore(self._limits[resource[0]])
+        return semaphore
+
+    async def offload(self, fn, *args, resource=None):
+        # the call runs in the context of the awaiting task, so it is traced and recorded under its case
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        async with self.limit(resource):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def run(self, steps, resource=None):
+        # runs a plan, see plan.py, its blocking calls are offloaded under the resource and its async calls are awaited
+        result, error = None, None
+        while True:
+            try:
+                operation = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                if isinstance(operation, plan.Offload):
+                    result = await self.offload(operation.fn, *operation.args, resource=resource)
+                elif isinstance(operation, plan.Sleep):
+                    await asyncio.sleep(operation.seconds)
+                elif isinstance(operation, plan.Spawn):
+                    result = asyncio.create_task(self.run(operation.plan, resource))
+                elif isinstance(operation, plan.Join):
+                    result = await operation.handle
+                elif isinstance(operation, plan.Cancel):
+                    operation.handle.cancel()
+                    # the error of a dropped plan is not reported
+                    operation.handle.add_done_callback(lambda task: task.cancelled() or task.exception())
+                elif inspect.isawaitable(operation):
+                    result = await operation
+                else:
+                    result = operation
+            except Exception as e:
+                error = e
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# runs the case files with one asyncio task per device, so the sessions of all devices and their model requests
+# interleave in one thread, see Engine._run_parallel for the thread per device variant
+class AsyncRunner:
+    def __init__(self, engine):
+        self.engine = engine
+        self.conf = engine.conf
+        self.runtime = None
+        self.locate = None
+        self.validate = None
+
+    def run(self, case_files):
+        return asyncio.run(self._run_all(case_files))
+
+    async def _run_all(self, case_files):
+        conf = self.conf
+        self.runtime = Runtime(conf.async_executor_workers, {"appium": conf.async_appium_concurrency, "model": conf.async_model_concurrency})
+        async_transport = transport.create_async_transport(conf)
+        self.locate = AsyncLocate(self.engine.locate, self.runtime, async_transport)
+        self.validate = AsyncValidate(self.engine.validate, self.runtime, async_transport)
+
+        # devices pull case files from a shared queue, so fast devices are never idle behind slow ones
+        pending = asyncio.Queue()
+        for file_path in case_files:
+            pending.put_nowait(file_path)
+        results = []
+        try:
+            # None is the single device of self.engine.client
+            await asyncio.gather(*(self._device(device, pending, results) for device in conf.devices or [None]))
+        finally:
+            await async_transport.close()
+            self.runtime.close()
+
+        if not pending.empty():
+            logging.error(f"no device is available, {pending.qsize()} case files are not executed")
+        return results
+
+    async def _device(self, device, pending, results):
+        engine = self.engine
+        appium_server_host = device.appium_server_host if device is not None else self.conf.appium_server_host
+        if device is None:
+            client = engine.client
+        else:
+            try:
+                # the daemon keeps the sessions of its devices, a single run creates and quits them
+                if engine.daemon:
+                    client = await self.runtime.offload(engine._healthy_client, engine._clients.get(device.name), device, resource=("appium", appium_server_host))
+                else:
+                    client = await self.runtime.offload(engine._create_client, device, resource=("appium", appium_server_host))
+            except Exception as e:
+                logging.error(f"device {device.name} is unavailable, skip it: {str(e)}")
+                engine._clients.pop(device.name, None)
+                return
+
+        async_client = AsyncClient(client, self.runtime, appium_server_host)
+        try:
+            while not pending.empty():
+                file_path = pending.get_nowait()
+                logging.info(f"execute case: {os.path.basename(file_path)}" + (f" on device: {device.name}" if device is not None else ""))
+                results.extend(await self.runtime.run(engine.file_plan(async_client, self.locate, self.validate, file_path, device.name if device is not None else "")))
+        finally:
+            if device is not None:
+                if engine.daemon:
+                    engine._clients[device.name] = client
+                else:
+                    await async_client.quit()
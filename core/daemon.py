@@ -0,0 +1,128 @@
+import json
+import time
+import socket
+import logging
+import threading
+import socketserver
+
+def _address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+# keeps the engine, its device sessions and models alive, and runs the cases submitted by submit.py one run at a time
+class Daemon:
+    def __init__(self, engine, address="127.0.0.1:6200", health_interval=60.0):
+        self._engine = engine
+        self._address = _address(address)
+        self._health_interval = health_interval
+        self._run_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+
+    def serve(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.rfile, self.wfile)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(self._address, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._check_health, name="daemon-health", daemon=True).start()
+        logging.info(f"daemon listening on {self._address[0]}:{self._address[1]}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+
+    def _check_health(self):
+        # a regular command keeps appium from closing idle sessions, lost sessions are connected again before the next run
+        while not self._stopped.wait(self._health_interval):
+            if not self._run_lock.acquire(blocking=False):
+                continue
+            try:
+                self._engine.check_clients()
+            except Exception as e:
+                logging.error(f"health check failed: {str(e)}")
+            finally:
+                self._run_lock.release()
+
+    def _handle(self, rfile, wfile):
+        write_lock = threading.Lock()
+        connected = [True]
+
+        def send(event):
+            # the run goes on if the cli is gone, its results are still in records/summary.json
+            if not connected[0]:
+                return
+            try:
+                with write_lock:
+                    wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                    wfile.flush()
+            except OSError:
+                connected[0] = False
+
+        line = rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send({"type": "error", "error": f"invalid request: {str(e)}"})
+            return
+
+        command = request.get("command")
+        if command == "health":
+            if not self._run_lock.acquire(blocking=False):
+                send({"type": "health", "busy": True})
+                return
+            try:
+                send({"type": "health", "busy": False, "clients": self._engine.check_clients()})
+            finally:
+                self._run_lock.release()
+        elif command == "stop":
+            send({"type": "stopped"})
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+        elif command == "run":
+            self._run(request.get("case_path"), send)
+        else:
+            send({"type": "error", "error": f"unknown command: {command}"})
+
+    def _run(self, case_path, send):
+        if not self._run_lock.acquire(blocking=False):
+            send({"type": "queued"})
+            self._run_lock.acquire()
+        try:
+            logging.info(f"run submitted cases: {case_path}")
+            self._engine.check_clients()
+            self._engine.listener = send
+            summary = self._engine._core(case_path)
+            if summary is None:
+                send({"type": "error", "error": f"no case is executed: {case_path}"})
+            else:
+                send({"type": "summary", **summary})
+        except Exception as e:
+            logging.exception("run submitted cases failed")
+            send({"type": "error", "error": str(e)})
+        finally:
+            self._engine.listener = None
+            self._run_lock.release()
+
+def submit(address, request, connect_timeout=0.0):
+    # sends one request to the daemon and yields the events it streams back
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            connection = socket.create_connection(_address(address))
+            break
+        except OSError:
+            # the daemon may still be loading its models
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(1)
+    with connection, connection.makefile("rb") as rfile:
+        connection.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+        for line in rfile:
+            yield json.loads(line)
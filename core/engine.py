@@ -1,21 +1,38 @@
 import os
-import shutil
+import json
+import queue
 import time
 import yaml
 import config
 import logging
 import argparse
+import threading
+import tracing
+import plan
+from concurrent.futures import ThreadPoolExecutor
 
-from mobile.client import AndroidClient, IOSClient
+from mobile import records
+from mobile.client import AndroidClient, IOSClient, Coordinate
 from models.locate import LocalLocate, RemoteLocate
 from models.validate import LocalValidate, RemoteValidate
+from models.cache import perceptual_hash
+from core.replay import ReplayStore
+from core.daemon import Daemon
+
+ACTIONS = ("click", "input", "swipe", "long_press", "multi_swipe")
 
 class Engine:
     def __init__(self, run_path):
         self.client = None
         self.locate = None
         self.validate = None
+        self.replay = None
+        self.records = None
         self.run_path=run_path
+        # called with every step and case result, the daemon streams them to the submitting cli
+        self.listener = None
+        # device name -> client, kept between runs in daemon mode
+        self._clients = {}
 
         parser = argparse.ArgumentParser(description='Automated Testing based on Appium and AI', formatter_class=argparse.RawTextHelpFormatter)
         parser.add_argument('--config-file', type=str, metavar='', help='\nConfiguration file path, default: ./config.yml')
@@ -28,7 +45,9 @@ class Engine:
         parser.add_argument('--device-type', type=str, metavar='', help='\nDevice type, support: android, ios')
         parser.add_argument('--app-package', type=str, metavar='', help='\nApplication package name')
         parser.add_argument('--app-activity', type=str, metavar='', help='\nApplication activity name')
+        parser.add_argument('--daemon', action='store_true', help='\nKeep the device session and models alive, and run the cases submitted by submit.py')
         args = parser.parse_args()
+        self.daemon = args.daemon
 
         if args.config_file is not None:
             if os.path.isabs(args.config_file):
@@ -49,19 +68,30 @@ class Engine:
             self.conf.app_package = args.app_package
         if args.app_activity is not None:
             self.conf.app_activity = args.app_activity
+        tracing.tracer.enabled = self.conf.trace_enabled
 
 
     def start(self):
         logging.info(f"the running path is : {self.run_path}")
-        if self.conf.device_type == "android":
-            self.client = AndroidClient(self.run_path, self.conf)
-        elif self.conf.device_type == "ios":
-            self.client = IOSClient(self.run_path, self.conf)
-        else:
+        if self.conf.device_type not in ("android", "ios"):
             logging.error(f"device type is not supported: {self.conf.device_type}")
             exit(1)
-        self.conf.device_width = self.client.device_width
-        self.conf.device_height = self.client.device_height
+        self._setup()
+        if self.daemon:
+            Daemon(self, self.conf.daemon_address, self.conf.daemon_health_interval).serve()
+        else:
+            self._core()
+
+    def _setup(self):
+        # shared with the clients, every run adds a manifest of its records
+        self.records = records.get_store(self.conf, self.run_path)
+        if self.conf.devices:
+            # in multi-device mode every worker creates its own client, see _run_parallel
+            logging.info(f"multi-device mode, devices: {[device.name for device in self.conf.devices]}")
+        else:
+            self.client = self._create_client()
+            self.conf.device_width = self.client.device_width
+            self.conf.device_height = self.client.device_height
         
         # initialize locate model
         if self.conf.locate_model_type == "local":
@@ -74,6 +104,12 @@ class Engine:
             logging.error(f"locate model mode is not supported: {self.conf.locate_model_type}")
             exit(1)
 
+        if self.conf.template_enabled:
+            # opencv is imported with the template backend, only when it is enabled
+            from models.template import TemplateLocate
+            self.locate = TemplateLocate(self.conf, self.run_path, self.locate)
+            logging.info("template matching enabled in front of the locate model")
+
         # initialize validate model
         if self.conf.validate_model_type == "local":
             self.validate = LocalValidate(self.conf, self.run_path)
@@ -84,34 +120,153 @@ class Engine:
         else:
             logging.error(f"validate model mode is not supported: {self.conf.validate_model_type}")
             exit(1)
-        self._core()
 
+        if self.conf.replay_enabled:
+            replay_path = self.conf.replay_path if os.path.isabs(self.conf.replay_path) else os.path.join(self.run_path, self.conf.replay_path)
+            self.replay = ReplayStore(replay_path, self.conf.replay_tolerance)
+
+    @tracing.traced("client", "client.connect")
+    def _create_client(self, device=None):
+        if self.conf.device_type == "android":
+            return AndroidClient(self.run_path, self.conf, device=device)
+        return IOSClient(self.run_path, self.conf, device=device)
+
+    def _healthy_client(self, client, device=None):
+        # the session may be dropped by appium or the device between runs, connect again if so
+        if client is not None and client.is_alive():
+            return client
+        if client is not None:
+            logging.warning(f"appium session of {device.name if device else 'the device'} is lost, reconnect")
+            try:
+                client.quit()
+            except Exception as e:
+                logging.info(f"quit the lost session failed: {str(e)}")
+        return self._create_client(device)
+
+    def check_clients(self):
+        if not self.conf.devices:
+            self.client = self._healthy_client(self.client)
+            return {"device": self.client is not None}
+        for device in self.conf.devices:
+            try:
+                self._clients[device.name] = self._healthy_client(self._clients.get(device.name), device)
+            except Exception as e:
+                logging.error(f"device {device.name} is unavailable: {str(e)}")
+                self._clients.pop(device.name, None)
+        return {device.name: device.name in self._clients for device in self.conf.devices}
 
-    def _core(self):
-        if os.path.isfile(self.case_path):
-            if self.case_path.startswith("test_") and self.case_path.endswith(".yml"):
-                logging.info(f"execute case: {self.case_path}")
-                self._run(self.case_path)
+    def _emit(self, event):
+        if self.listener is not None:
+            self.listener(event)
+
+    def _core(self, case_path=None):
+        case_path = case_path or self.case_path
+        started_at = time.time()
+        tracing.tracer.reset()
+        if os.path.isfile(case_path):
+            file_name = os.path.basename(case_path)
+            if file_name.startswith("test_") and file_name.endswith(".yml"):
+                case_files = [case_path]
             else:
-                logging.error(f"case file is not a yml file: {self.case_path}")
+                logging.error(f"case file is not a yml file: {case_path}")
+                return None
         else:
-            logging.info(f"execute all cases in {self.case_path}")
-            # clear existing execution records, including screencaps and screencaps_validation
-            screencaps_path = os.path.join(self.run_path, "records/screencaps")
-            if os.path.exists(screencaps_path):
-                shutil.rmtree(screencaps_path)
-            screenrecords_path = os.path.join(self.run_path, "records/screenrecords")
-            if os.path.exists(screenrecords_path):
-                shutil.rmtree(screenrecords_path)
-
-            for file in os.listdir(self.case_path):
+            logging.info(f"execute all cases in {case_path}")
+            case_files = []
+            for file in sorted(os.listdir(case_path)):
                 if file.startswith("test_") and file.endswith(".yml"):
-                    logging.info(f"execute case: {file}")
-                    self._run(os.path.join(self.case_path, file))
+                    case_files.append(os.path.join(case_path, file))
                 else:
                     logging.warning(f"case file is not start with test_ or not a yml file: {file}")
 
-    def _run(self, file_path):
+        # records of earlier runs are kept, the retention of the store removes old ones
+        run_id = self.records.begin_run()
+        logging.info(f"records of this run: {os.path.join(self.records.path, 'runs', run_id)}.json")
+        if self.conf.async_enabled:
+            # the async core is imported only when it is enabled
+            from core.aio import AsyncRunner
+            results = AsyncRunner(self).run(case_files)
+        elif self.conf.devices:
+            results = self._run_parallel(case_files)
+        else:
+            results = []
+            for file_path in case_files:
+                logging.info(f"execute case: {os.path.basename(file_path)}")
+                results.extend(self._run(self.client, file_path))
+        return self._summarize(results, time.time() - started_at)
+
+    def _run_parallel(self, case_files):
+        # devices pull case files from a shared queue, so fast devices are never idle behind slow ones
+        pending = queue.Queue()
+        for file_path in case_files:
+            pending.put(file_path)
+        results = []
+        results_lock = threading.Lock()
+
+        def work(device):
+            threading.current_thread().name = device.name
+            try:
+                # the daemon keeps the sessions of its devices, a single run creates and quits them
+                client = self._healthy_client(self._clients.get(device.name), device) if self.daemon else self._create_client(device)
+            except Exception as e:
+                logging.error(f"device {device.name} is unavailable, skip it: {str(e)}")
+                self._clients.pop(device.name, None)
+                return
+            try:
+                while True:
+                    try:
+                        file_path = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    logging.info(f"execute case: {os.path.basename(file_path)} on device: {device.name}")
+                    file_results = self._run(client, file_path, device.name)
+                    with results_lock:
+                        results.extend(file_results)
+            finally:
+                if self.daemon:
+                    self._clients[device.name] = client
+                else:
+                    client.quit()
+
+        with ThreadPoolExecutor(max_workers=len(self.conf.devices), thread_name_prefix="device") as executor:
+            list(executor.map(work, self.conf.devices))
+
+        if not pending.empty():
+            logging.error(f"no device is available, {pending.qsize()} case files are not executed")
+        return results
+
+    def _summarize(self, results, duration):
+        passed = [result for result in results if result.passed]
+        failed = [result for result in results if not result.passed]
+        logging.info(f"summary: total {len(results)}, passed {len(passed)}, failed {len(failed)}, duration {duration:.1f}s")
+        for result in failed:
+            logging.error(f"failed case: {result}")
+        phases = tracing.tracer.aggregate()
+        for name, phase in phases.items():
+            logging.info(f"phase {name}: count {phase['count']}, total {phase['total']:.3f}s, p50 {phase['p50']:.3f}s, p95 {phase['p95']:.3f}s")
+
+        summary = {
+            "total": len(results),
+            "passed": len(passed),
+            "failed": len(failed),
+            "duration": round(duration, 3),
+            "cases": [result.to_dict() for result in results],
+            "phases": phases
+        }
+        summary_path = os.path.join(self.run_path, "records/summary.json")
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        logging.info(f"summary saved successfully, path: {summary_path}")
+        manifest_path = self.records.end_run({key: summary[key] for key in ("total", "passed", "failed", "duration")})
+        logging.info(f"records manifest saved successfully, path: {manifest_path}")
+        if self.conf.trace_enabled:
+            trace_path = self.conf.trace_path if os.path.isabs(self.conf.trace_path) else os.path.join(self.run_path, self.conf.trace_path)
+            tracing.tracer.export_chrome(trace_path)
+            logging.info(f"trace saved successfully, path: {trace_path}")
+        return summary
+
+    def _load_cases(self, file_path):
         with open(file_path, "r", encoding="utf-8") as f:
             cases_data = yaml.safe_load(f)["cases"]
 
@@ -121,65 +276,184 @@ class Engine:
                 name=case_data["case"]["name"],
                 steps=case_data["case"]["steps"]
             )
-        cases.append(case)
+            cases.append(case)
+        return cases
+
+    def _run(self, client, file_path, device_name=""):
+        # runs the speculative locate of the next step while the current step is validated
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{threading.current_thread().name}-prefetch") as executor:
+            return plan.run(self.file_plan(client, self.locate, self.validate, file_path, device_name), executor)
 
-        for case in cases:
-            self.client.start_screenrecord()
-            logging.info(f"- execute case: {case.name}")
-            for step in case.steps:
-                time.sleep(2)
+    def file_plan(self, client, locate, validate, file_path, device_name=""):
+        # the cases of a file as a plan, see plan.py, _run gives it the blocking client, locate and validate
+        # and core.aio.AsyncRunner their awaitable wrappers
+        file_name = os.path.basename(file_path)
+        results = []
+        for case in self._load_cases(file_path):
+            result = CaseResult(file_name, case.name, device_name)
+            started_at = time.time()
+            case_key = f"{result.file}::{case.name}"
+            with tracing.tracer.case(case_key), records.context(file=result.file, case=case.name, device=device_name), \
+                    tracing.span("case", file=result.file, case=case.name, device=device_name):
+                yield client.start_screenrecord()
+                logging.info(f"- execute case: {case.name}")
+                yield from self._case_plan(client, locate, validate, file_name, case, result)
+                yield client.stop_screenrecord(case.name)
+            result.duration = time.time() - started_at
+            result.phases = tracing.tracer.aggregate(case_key)
+            results.append(result)
+            self._emit({"type": "case", **result.to_dict()})
+        yield client.flush_records()
+        return results
+
+    def _case_plan(self, client, locate, validate, file_name, case, result):
+        device_pixel_config = (client.device_width, client.device_height)
+        # the coordinates of the current step, located on the validation frame of the previous step
+        prefetched = None
+        step = None
+        index = 0
+        # (key, action, queries, fingerprint, coordinates) of every step, stored for replay when the case passes
+        recorded = []
+        replayed = []
+        executed = []
+        # the screenshots of the passed steps without a validation, the locate learns from them when the case passes
+        unvalidated = []
+        try:
+            for index, step in enumerate(case.steps):
+                records.set_step(index)
                 logging.info(f"-- execute step: {step}")
-                if step.action == "click":
-                    self.client.take_screenshot(step.element)
-                    coordinate = self.locate.locate_pixel(step.element)
-                    self.client.touch_at_coordinate(coordinate)
-                    if step.validation:
-                        time.sleep(2)
-                        self.client.take_screenshot(f"{step.element}_validation")
-                        is_ok = self.validate.validate(step.element, step.validation)
-                        if not is_ok:
-                            logging.error(f"case 【{case.name}】 failed at step 【{step}】")
-                            break
-                elif step.action == "input":
-                    self.client.take_screenshot(step.element)
-                    coordinate = self.locate.locate_pixel(step.element)
-                    self.client.touch_at_coordinate(coordinate)
-                    self.client.send_keys(coordinate, step.text)
-                    if step.validation:
-                        time.sleep(2)
-                        self.client.take_screenshot(f"{step.element}_validation")
-                        is_ok = self.validate.validate(step.element, step.validation)
-                        if not is_ok:
-                            logging.error(f"case 【{case.name}】 failed at step 【{step}】")
-                            break
-                elif step.action == "swipe":
-                    self.client.take_screenshot(step.from_element)
-                    from_coordinate = self.locate.locate_pixel(step.from_element)
-                    self.client.take_screenshot(step.to_element)
-                    to_coordinate = self.locate.locate_pixel(step.to_element)
-                    self.client.swipe_from_coordinate(from_coordinate, to_coordinate)
-                    if step.validation:
-                        time.sleep(2)
-                        self.client.take_screenshot(f"{step.to_element}_validation")
-                        is_ok = self.validate.validate(step.to_element, step.validation)
-                        if not is_ok:
-                            logging.error(f"case 【{case.name}】 failed at step 【{step}】")
-                            break
-                else:
+                if step.action not in ACTIONS:
                     logging.info(f"unknown action: {step.action}")
-            self.client.stop_screenrecord(case.name)
+                    prefetched = None
+                    continue
+
+                if prefetched is not None:
+                    with tracing.span("prefetch.wait"):
+                        coordinates = yield plan.Join(prefetched)
+                    prefetched = None
+                    located_screenshot = prefetched_screenshot
+                else:
+                    yield client.wait_for_settle()
+                    located_screenshot = yield client.take_screenshot(step.locate_name)
+                    coordinates = yield from self._locate_plan(locate, step, located_screenshot, device_pixel_config, ReplayStore.step_key(file_name, case.name, index), recorded, replayed)
+                yield from self._act_plan(client, step, coordinates)
+                executed.append(ReplayStore.step_key(file_name, case.name, index))
+
+                if step.validation:
+                    yield client.wait_for_settle()
+                    screenshot = yield client.take_screenshot(step.validation_name)
+                    # the validation frame is the screen the next step starts on, locate on it while validating
+                    next_step = case.steps[index + 1] if index + 1 < len(case.steps) else None
+                    if next_step is not None and next_step.action in ACTIONS:
+                        prefetched_screenshot = client.reuse_screenshot(screenshot, next_step.locate_name, index + 1)
+                        prefetched = yield plan.Spawn(self._locate_plan(locate, next_step, prefetched_screenshot, device_pixel_config,
+                                                                        ReplayStore.step_key(file_name, case.name, index + 1), recorded, replayed, reused=True))
+                    with tracing.span("validate", "validate"):
+                        is_ok = yield validate.validate(screenshot, step.validation)
+                    if not is_ok:
+                        # the speculative locate is thrown away, nothing is tapped on a failed screen
+                        logging.error(f"case 【{case.name}】 failed at step 【{step}】")
+                        result.fail(step)
+                        self._emit_step(result, index, step)
+                        break
+                    yield locate.learn(located_screenshot)
+                else:
+                    unvalidated.append(located_screenshot)
+                self._emit_step(result, index, step)
+        except Exception as e:
+            logging.error(f"case 【{case.name}】 failed with error: {str(e)}")
+            result.fail(step, str(e))
+            self._emit_step(result, index, step)
+        if prefetched is not None:
+            yield plan.Cancel(prefetched)
+        if result.passed:
+            for located_screenshot in unvalidated:
+                yield locate.learn(located_screenshot)
+
+        if self.replay is not None:
+            if result.passed:
+                yield plan.Offload(self.replay.record, recorded)
+            else:
+                # a replayed coordinate may have caused the failure, locate these steps again next time
+                yield plan.Offload(self.replay.discard, [key for key in replayed if key in executed])
+
+    def _emit_step(self, result, index, step):
+        self._emit({"type": "step", "file": result.file, "case": result.name, "device": result.device, "index": index, "step": str(step),
+                    "passed": result.passed, "error": result.error})
+
+    def _locate_plan(self, locate, step, screenshot, device_pixel_config, replay_key, recorded, replayed, reused=False):
+        # reused is true for the validation frame of the previous step, take_screenshot has not recorded it for this step
+        with tracing.span("locate", "locate"):
+            fingerprint = None
+            if self.replay is not None:
+                fingerprint = yield plan.Offload(lambda: perceptual_hash(screenshot.image))
+                ratios = self.replay.lookup(replay_key, step.action, step.queries, fingerprint)
+                if ratios is not None:
+                    logging.info(f"replay the coordinates of step {replay_key}")
+                    if reused:
+                        yield plan.Offload(screenshot.save)
+                    replayed.append(replay_key)
+                    recorded.append((replay_key, step.action, step.queries, fingerprint, ratios))
+                    return [Coordinate(x_pixel=x_ratio * device_pixel_config[0], y_pixel=y_ratio * device_pixel_config[1]) for x_ratio, y_ratio in ratios]
+
+            coordinates = yield locate.locate_many(screenshot, step.queries, device_pixel_config)
+
+            if self.replay is not None:
+                ratios = [[coordinate.x_pixel / device_pixel_config[0], coordinate.y_pixel / device_pixel_config[1]] for coordinate in coordinates]
+                recorded.append((replay_key, step.action, step.queries, fingerprint, ratios))
+            return coordinates
+
+    def _act_plan(self, client, step, coordinates):
+        with tracing.span("act", "client"):
+            if step.action == "click":
+                yield client.touch_at_coordinate(coordinates[0])
+            elif step.action == "input":
+                # the tap and the keys are one gesture
+                yield client.send_keys(coordinates[0], step.text)
+            elif step.action == "long_press":
+                yield client.long_press_at_coordinate(coordinates[0], step.duration or 1000)
+            elif step.action == "swipe":
+                yield client.swipe_from_coordinate(coordinates[0], coordinates[1], step.duration or 500)
+            elif step.action == "multi_swipe":
+                # the points of all paths were located together, split them back into one path per finger
+                paths = []
+                for path in step.paths:
+                    paths.append(coordinates[:len(path)])
+                    coordinates = coordinates[len(path):]
+                yield client.multi_swipe(paths, step.duration or 500)
 
 class Step:
-    def __init__(self, element, action, text=None, from_element=None, to_element=None, validation=None):
+    def __init__(self, element, action, text=None, from_element=None, to_element=None, validation=None, duration=None, paths=None):
         self.element = element
         self.action = action
         self.text = text
         self.from_element = from_element
         self.to_element = to_element
         self.validation = validation
+        # milliseconds of a long press or a swipe
+        self.duration = duration
+        # the elements every finger of a multi_swipe moves through, one list per finger
+        self.paths = paths or []
+
+    @property
+    def queries(self):
+        # the elements located for the step, all points of a swipe are on the same screen and located together
+        if self.action == "swipe":
+            return [self.from_element, self.to_element]
+        if self.action == "multi_swipe":
+            return [element for path in self.paths for element in path]
+        return [self.element]
+
+    @property
+    def locate_name(self):
+        return self.queries[0]
+
+    @property
+    def validation_name(self):
+        return f"{self.queries[-1]}_validation"
 
     def __str__(self):
-        return f"Step(element={self.element}, action={self.action}, text={self.text}, from_element={self.from_element}, to_element={self.to_element}, validation={self.validation})"
+        return f"Step(element={self.element}, action={self.action}, text={self.text}, from_element={self.from_element}, to_element={self.to_element}, paths={self.paths}, validation={self.validation})"
 
 class Case:
     def __init__(self, name, steps):
@@ -190,8 +464,42 @@ class Case:
             text=step.get("text"),
             from_element=step.get("from_element"),
             to_element=step.get("to_element"),
-            validation=step.get("validation")
+            validation=step.get("validation"),
+            duration=step.get("duration"),
+            paths=step.get("paths")
         ) for step in steps]
 
     def __str__(self):
         return f"Case(name={self.name}, steps={self.steps})"
+
+class CaseResult:
+    def __init__(self, file, name, device=""):
+        self.file = file
+        self.name = name
+        self.device = device
+        self.passed = True
+        self.failed_step = None
+        self.error = None
+        self.duration = 0.0
+        # span name -> count, total, p50 and p95 of this case, see tracing.Tracer.aggregate
+        self.phases = {}
+
+    def fail(self, step, error=None):
+        self.passed = False
+        self.failed_step = str(step)
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "file": self.file,
+            "name": self.name,
+            "device": self.device,
+            "passed": self.passed,
+            "failed_step": self.failed_step,
+            "error": self.error,
+            "duration": round(self.duration, 3),
+            "phases": self.phases
+        }
+
+    def __str__(self):
+        return f"CaseResult(file={self.file}, name={self.name}, device={self.device}, passed={self.passed}, failed_step={self.failed_step}, error={self.error})"
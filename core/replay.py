@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+import threading
+from models.cache import hamming_distance
+
+# coordinates of passed cases, replayed when a later run sees the same screen at the same step
+class ReplayStore:
+    def __init__(self, path, tolerance=2):
+        self._path = path
+        self._tolerance = tolerance
+        self._lock = threading.Lock()
+        # step key -> {"action": action of the step, "queries": its elements, "fingerprint": hex of the perceptual hash,
+        # "coordinates": [[x ratio, y ratio], ...]}
+        self._steps = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._steps = json.load(f)
+        logging.info(f"replay store loaded, path: {path}, steps: {len(self._steps)}")
+
+    @staticmethod
+    def step_key(file_name, case_name, step_index):
+        return f"{file_name}::{case_name}::{step_index}"
+
+    def lookup(self, key, action, queries, fingerprint):
+        with self._lock:
+            step = self._steps.get(key)
+        if step is None or hamming_distance(int(step["fingerprint"], 16), fingerprint) > self._tolerance:
+            return None
+        # an edited step of the case file is located again, even on the same screen
+        if step.get("action") != action or step.get("queries") != list(queries):
+            return None
+        return step["coordinates"]
+
+    def record(self, steps):
+        # steps is a list of (key, action, queries, fingerprint, coordinates) of a passed case
+        if not steps:
+            return
+        with self._lock:
+            for key, action, queries, fingerprint, coordinates in steps:
+                self._steps[key] = {"action": action, "queries": list(queries), "fingerprint": f"{fingerprint:016x}", "coordinates": coordinates}
+            self._save()
+
+    def discard(self, keys):
+        with self._lock:
+            removed = [key for key in keys if self._steps.pop(key, None) is not None]
+            if removed:
+                logging.info(f"replay steps discarded: {removed}")
+                self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._steps, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self._path)
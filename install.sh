@@ -1,4 +1,10 @@
 #!/bin/bash
+# ./install.sh installs the remote mode dependencies, ./install.sh --local also installs torch and transformers for local mode
+requirements_file="requirements.txt"
+if [[ "$1" == "--local" ]]; then
+    requirements_file="requirements-local.txt"
+fi
+
 # check if brew is installed
 if ! brew -v >/dev/null 2>&1; then
     printf "brew is not installed, starting to install brew\n"
@@ -103,10 +109,10 @@ fi
 ping -c 2 -W 3 pypi.org >/dev/null 2>&1
 if [ $? -eq 0 ]; then
     printf "Pypi mirror address is not needed\n"
-    pip3 install -r requirements.txt
+    pip3 install -r $requirements_file
 else
     printf "Pypi mirror address is needed\n"
-    pip3 install -r requirements.txt -i https://pypi.tuna.tsinghua.edu.cn/simple
+    pip3 install -r $requirements_file -i https://pypi.tuna.tsinghua.edu.cn/simple
 fi
 
 if [ $? -ne 0 ]; then
@@ -119,7 +125,12 @@ printf "Successfully installed all dependencies\n"
 VIRTUAL_ENV=$(python -c "import sys; print(sys.prefix)")
 
 # pyinstaller --onefile --path "${VIRTUAL_ENV}/lib/python3.12/site-packages" --add-data "${VIRTUAL_ENV}/lib/python3.12/site-packages/gradio_client/types.json:gradio_client" --exclude-module "showui-2b" --exclude-module "qwen2-vl" --name aitest aitest.py
-pyinstaller --onefile --path "${VIRTUAL_ENV}/lib/python3.12/site-packages" --exclude-module "showui-2b" --exclude-module "qwen2-vl" --name aitest aitest.py
+# the ml stack is imported lazily, leave it out of the remote mode executable even if it is installed
+exclude_modules=""
+if [[ "$requirements_file" == "requirements.txt" ]]; then
+    exclude_modules='--exclude-module torch --exclude-module torchvision --exclude-module transformers --exclude-module qwen_vl_utils --exclude-module huggingface_hub --exclude-module accelerate'
+fi
+pyinstaller --onefile --path "${VIRTUAL_ENV}/lib/python3.12/site-packages" --exclude-module "showui-2b" --exclude-module "qwen2-vl" $exclude_modules --name aitest aitest.py
 
 mv dist/aitest aitest && chmod +x aitest
 
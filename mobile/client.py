@@ -1,10 +1,19 @@
 import os
 import time
+import base64
 import config
+import plan
+import threading
 import logging
+from io import BytesIO
+from PIL import Image, ImageChops, ImageStat
+from mobile import records
+from mobile.records import RecordStore
+from mobile.hierarchy import HierarchyIndex
+from tracing import traced, span
 from appium.options.android import UiAutomator2Options
 from appium import webdriver
-from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.remote.command import Command
 
 # defind Android and iOS enums
 class DevicePlatform:
@@ -16,106 +25,418 @@ class Coordinate():
         self.x_pixel = x_pixel
         self.y_pixel = y_pixel
 
+# a screenshot captured once and shared in memory by the locate and validate models
+class Screenshot:
+    def __init__(self, png: bytes, record_key: dict = None, store: RecordStore = None, page_source_loader=None):
+        self.png = png
+        # the file, case, device, step and name of the screenshot in the manifest of the run
+        self.record_key = record_key
+        self._store = store
+        self._page_source_loader = page_source_loader
+        self._hierarchy = None
+        self._image = None
+        self._base64 = None
+        # encoded variants for remote models, keyed by their preprocessing options
+        self.encodings = {}
+        # the prefetch locate and the validation work on the same frame at the same time, the lock is shared with
+        # the reused copies of the screenshot, so it is decoded and encoded only once
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "Screenshot":
+        # a screenshot of decoded pixels, used by model workers that receive no png bytes
+        screenshot = cls(None)
+        screenshot._image = image
+        return screenshot
+
+    @property
+    def image(self) -> Image.Image:
+        # decoded lazily and only once, remote models only need the png bytes
+        with self._lock:
+            if self._image is None:
+                image = Image.open(BytesIO(self.png))
+                image.load()
+                self._image = image
+            return self._image
+
+    @property
+    def hierarchy(self) -> HierarchyIndex:
+        # the page source of the same screen, fetched at most once and only when a locate asks for it
+        if self._hierarchy is None and self._page_source_loader is not None:
+            self._hierarchy = HierarchyIndex(self._page_source_loader())
+        return self._hierarchy
+
+    def base64(self):
+        with self._lock:
+            if self._base64 is None:
+                self._base64 = base64.b64encode(self.png).decode("utf-8")
+            return self._base64
+
+    def encoding(self, key, encode):
+        # the encoded variant of key, made by encode on the first call, parallel callers wait for it
+        with self._lock:
+            if key not in self.encodings:
+                self.encodings[key] = encode(self)
+            return self.encodings[key]
+
+    def save(self, image: Image.Image = None):
+        # record the screenshot, or an annotated copy of it, in the background
+        if self._store is not None and self.record_key is not None:
+            if image is None:
+                self._store.record(self.png, self.record_key)
+            else:
+                self._store.record(image, {**self.record_key, "kind": "marked"})
+
+
+# wait until the screen stops changing, instead of sleeping a fixed time after every action
+class ScreenSettle:
+    def __init__(self, driver: webdriver.Remote, threshold=0.005, timeout=5.0, interval=0.2, stable_frames=1, thumbnail_width=64):
+        self.driver = driver
+        self.threshold = threshold
+        self.timeout = timeout
+        self.interval = interval
+        self.stable_frames = stable_frames
+        self.thumbnail_width = thumbnail_width
+        self.last_png = None
+        # (png, thumbnail) of the last decoded frame, every frame is decoded at most once
+        self._decoded = None
+
+    def _frame(self):
+        # every poll is a full resolution png from appium, there is no reduced frame to fetch instead,
+        # so a settle costs at least stable_frames + 1 screenshots
+        self.last_png = self.driver.get_screenshot_as_png()
+        return self.last_png
+
+    def _thumbnail(self, png):
+        if self._decoded is not None and self._decoded[0] is png:
+            return self._decoded[1]
+        # the frame is shrunk to a small gray image, the comparison ignores sub-pixel noise
+        image = Image.open(BytesIO(png)).convert("L")
+        height = max(1, round(image.height * self.thumbnail_width / image.width))
+        thumbnail = image.resize((self.thumbnail_width, height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        self._decoded = (png, thumbnail)
+        return thumbnail
+
+    def _difference(self, previous, current):
+        # an unchanged screen gives the same png bytes, that needs no decoding at all
+        if previous == current:
+            return 0.0
+        return ImageStat.Stat(ImageChops.difference(self._thumbnail(previous), self._thumbnail(current))).mean[0] / 255
+
+    def wait(self, timeout=None):
+        return plan.run(self.wait_plan(timeout))
+
+    def wait_plan(self, timeout=None):
+        # the loop of wait as a plan, see plan.py, the async core runs it without holding a thread between the frames
+        timeout = self.timeout if timeout is None else timeout
+        started_at = time.monotonic()
+        deadline = started_at + timeout
+        previous = yield plan.Offload(self._frame)
+        stable = 0
+        while time.monotonic() < deadline:
+            yield plan.Sleep(self.interval)
+            current = yield plan.Offload(self._frame)
+            difference = yield plan.Offload(self._difference, previous, current)
+            previous = current
+            if difference <= self.threshold:
+                stable += 1
+                if stable >= self.stable_frames:
+                    logging.info(f"screen settled in {time.monotonic() - started_at:.2f}s")
+                    return True
+            else:
+                stable = 0
+        logging.info(f"screen is not settled in {timeout}s, continue")
+        return False
+
+
+# w3c actions of a gesture, every pointer source is a finger and the key source types after the fingers are released
+class Gesture:
+    def __init__(self):
+        self._pointers = []
+        self._keys = []
+
+    def _finger(self):
+        actions = []
+        self._pointers.append(actions)
+        return actions
+
+    def tap(self, coordinate: Coordinate, hold=100) -> "Gesture":
+        self._finger().extend([
+            {"type": "pointerMove", "duration": 0, "x": round(coordinate.x_pixel), "y": round(coordinate.y_pixel)},
+            {"type": "pointerDown", "button": 0},
+            {"type": "pause", "duration": hold},
+            {"type": "pointerUp", "button": 0},
+        ])
+        return self
+
+    def swipe(self, path, duration=500) -> "Gesture":
+        # the finger goes through every coordinate of the path, the duration is split evenly between the moves
+        actions = self._finger()
+        actions.extend([
+            {"type": "pointerMove", "duration": 0, "x": round(path[0].x_pixel), "y": round(path[0].y_pixel)},
+            {"type": "pointerDown", "button": 0},
+            {"type": "pause", "duration": 100},
+        ])
+        step_duration = round(duration / max(1, len(path) - 1))
+        for coordinate in path[1:]:
+            actions.append({"type": "pointerMove", "duration": step_duration, "x": round(coordinate.x_pixel), "y": round(coordinate.y_pixel)})
+        actions.append({"type": "pointerUp", "button": 0})
+        return self
+
+    def type(self, text, focus_delay=300) -> "Gesture":
+        # the pause gives the tapped input time to take the focus
+        self._keys.append({"type": "pause", "duration": focus_delay})
+        for key in text:
+            self._keys.extend([{"type": "keyDown", "value": key}, {"type": "keyUp", "value": key}])
+        return self
+
+    def payload(self):
+        sources = [
+            {"type": "pointer", "id": f"finger{index + 1}", "parameters": {"pointerType": "touch"}, "actions": actions}
+            for index, actions in enumerate(self._pointers)
+        ]
+        if self._keys:
+            # actions of all sources run tick by tick, the keys wait until the longest finger is done
+            ticks = max((len(actions) for actions in self._pointers), default=0)
+            sources.append({"type": "key", "id": "keyboard", "actions": [{"type": "pause", "duration": 0}] * ticks + self._keys})
+        return {"actions": sources}
+
 
 # define the base class for all clients
 class Client:
-    def __init__(self, run_path: str, driver: webdriver.Remote):
+    def __init__(self, run_path: str, driver: webdriver.Remote, store: RecordStore = None, conf: config.Config = None):
         self.run_path = run_path
+        # the records of all devices share one store, the device is part of the key of every record
+        self.records = store if store is not None else RecordStore(os.path.join(run_path, 'records'))
         self.driver = driver
+        # the last frame of a settled screen, reused by the next screenshot if no action happens in between
+        self._settled_png = None
         self.device_width = driver.get_window_size()['width']
         self.device_height = driver.get_window_size()['height']
         logging.info(f"device width: {self.device_width}, device height: {self.device_height}")
+        if conf is not None:
+            self.settle = ScreenSettle(driver, conf.settle_threshold, conf.settle_timeout, conf.settle_interval, conf.settle_stable_frames)
+        else:
+            self.settle = ScreenSettle(driver)
 
-    def take_screenshot(self, image_name, file_format='png'):
-        try:
-            img_folder = os.path.join(self.run_path, 'records/screencaps')
+    @traced("client")
+    def wait_for_settle(self, timeout=None):
+        return plan.run(self.settle_plan(timeout))
 
-            if not os.path.exists(img_folder):
-                os.makedirs(img_folder)
+    def settle_plan(self, timeout=None):
+        # wait_for_settle as a plan, see plan.py, AsyncClient runs it on its runtime
+        try:
+            settled = yield from self.settle.wait_plan(timeout)
+            self._settled_png = self.settle.last_png if settled else None
+            return settled
+        except Exception as e:
+            logging.info(f"wait for settle error: {str(e)}")
+            self._settled_png = None
+            return False
 
-            screen_save_path = os.path.join(img_folder, f"{image_name}.{file_format}")
-            self.driver.get_screenshot_as_file(os.path.abspath(screen_save_path))
-            if os.path.exists(screen_save_path):
-                logging.info(f"screenshot saved successfully, path: {os.path.abspath(screen_save_path)}")
-                return True
-            else:
-                logging.info("screenshot saved failed")
-                return False
+    @traced("client")
+    def take_screenshot(self, image_name):
+        try:
+            png = self._settled_png
+            self._settled_png = None
+            if png is None:
+                png = self.driver.get_screenshot_as_png()
+            screenshot = Screenshot(png, records.current_key(name=image_name, kind="screenshot"), self.records, self._page_source)
+            screenshot.save()
+            logging.info(f"screenshot taken successfully: {image_name}")
+            return screenshot
         except Exception as e:
             logging.info(f"screenshot error: {str(e)}")
-            return False
+            return None
+
+    def reuse_screenshot(self, screenshot: Screenshot, image_name, step=None):
+        # the same frame recorded under another name, or for another step, the decoded image and encodings are shared
+        record_key = records.current_key(name=image_name, kind="screenshot")
+        if step is not None:
+            record_key["step"] = step
+        reused = Screenshot(screenshot.png, record_key, self.records, self._page_source)
+        reused._image = screenshot.image
+        reused._hierarchy = screenshot._hierarchy
+        reused.encodings = screenshot.encodings
+        reused._lock = screenshot._lock
+        return reused
+
+    @traced("client", "client.page_source")
+    def _page_source(self):
+        return self.driver.page_source
 
+    @traced("client")
+    def flush_records(self):
+        self.records.flush()
+
+    @traced("client")
     def start_screenrecord(self):
         try:
             self.driver.start_recording_screen()
 
-            time.sleep(3)
+            self.wait_for_settle()
             return True
         except Exception as e:
             logging.info(f"start screenrecord error: {str(e)}")
             return False
 
+    @traced("client")
     def stop_screenrecord(self, case_name, file_format='mp4'):
         try:
-            video_folder = os.path.join(self.run_path, 'records/screenrecords')
-
-            if not os.path.exists(video_folder):
-                os.makedirs(video_folder)
-
-            screen_save_path = os.path.join(video_folder, f"{case_name}.{file_format}")
-
-            screen_recording = self.driver.stop_recording_screen()
-
-            with open(screen_save_path, "wb") as file:
-                file.write(screen_recording)
-
-            if os.path.exists(screen_save_path):
-                logging.info(f"screenrecord saved successfully, path: {screen_save_path}")
-                return True
-            else:
-                logging.info("screenrecord saved failed")
+            # appium returns the video base64 encoded
+            screen_recording = base64.b64decode(self.driver.stop_recording_screen() or "")
+            if not screen_recording:
+                logging.info("screenrecord is empty, skip it")
                 return False
+            self.records.record(screen_recording, records.current_key(name=case_name, kind="screenrecord", step=None), file_format)
+            logging.info(f"screenrecord recorded: {case_name}")
+            return True
         except Exception as e:
             logging.info(f"stop screenrecord error: {str(e)}")
             return False
 
+    def perform(self, gesture: "Gesture"):
+        # the whole gesture is one w3c actions request, appium runs it without further round trips
+        self._settled_png = None
+        self.driver.execute(Command.W3C_ACTIONS, gesture.payload())
+
+    @traced("client")
     def touch_at_coordinate(self, coordinate: Coordinate):
         try:
-            self.driver.tap([(coordinate.x_pixel, coordinate.y_pixel)])
+            self.perform(Gesture().tap(coordinate))
             return True
         except Exception as e:
             logging.info(f"touch at coordinate failed: {str(e)}")
             return False
 
+    @traced("client")
+    def long_press_at_coordinate(self, coordinate: Coordinate, duration=1000):
+        try:
+            self.perform(Gesture().tap(coordinate, hold=duration))
+            return True
+        except Exception as e:
+            logging.info(f"long press at coordinate failed: {str(e)}")
+            return False
+
+    @traced("client")
     def swipe_from_coordinate(self, from_coordinate: Coordinate, to_coordinate: Coordinate, duration=500):
         try:
-            self.driver.press(x=from_coordinate.x_pixel, y=from_coordinate.y_pixel).wait(duration).move_to(x=to_coordinate.x_pixel, y=to_coordinate.y_pixel).release().perform()
+            self.perform(Gesture().swipe([from_coordinate, to_coordinate], duration))
             return True
         except Exception as e:
             logging.info(f"swipe from coordinate failed: {str(e)}")
             return False
 
-    def send_keys(self, coordinate: Coordinate, content):
+    @traced("client")
+    def multi_swipe(self, paths, duration=500):
+        # one finger per path, all fingers move at the same time, e.g. a pinch
         try:
-            self.driver.tap([(coordinate.x_pixel, coordinate.y_pixel)])
-            time.sleep(1)
+            gesture = Gesture()
+            for path in paths:
+                gesture.swipe(path, duration)
+            self.perform(gesture)
+            return True
+        except Exception as e:
+            logging.info(f"multi swipe failed: {str(e)}")
+            return False
 
+    @traced("client")
+    def send_keys(self, coordinate: Coordinate, content):
+        # tap the input and type the content in one gesture, the keys are sent after the tap is released
+        try:
+            gesture = Gesture().tap(coordinate)
             if content is None:
                 logging.info("text content is empty, skip input")
-                return True
-
-            ActionChains(self.driver).send_keys(content).perform()
+            else:
+                gesture.type(str(content))
+            self.perform(gesture)
             return True
-
         except Exception as e:
             logging.info(f"send keys failed: {str(e)}")
             return False
 
+    def is_alive(self):
+        # a cheap command of the session, it fails when appium or the device dropped the session
+        try:
+            self.driver.get_window_size()
+            return True
+        except Exception as e:
+            logging.info(f"appium session is not alive: {str(e)}")
+            return False
+
     def quit(self):
+        self.flush_records()
         self.driver.quit()
 
+# awaitable operations of a client for the async core, the selenium calls run in the executor of the runtime
+# and at most the appium limit of them are in flight per appium server
+class AsyncClient:
+    def __init__(self, client: Client, runtime, appium_server_host):
+        self.client = client
+        self._runtime = runtime
+        self._resource = ("appium", appium_server_host)
+
+    @property
+    def device_width(self):
+        return self.client.device_width
+
+    @property
+    def device_height(self):
+        return self.client.device_height
+
+    async def _call(self, fn, *args):
+        return await self._runtime.offload(fn, *args, resource=self._resource)
+
+    async def wait_for_settle(self, timeout=None):
+        with span("client.wait_for_settle", "client"):
+            return await self._runtime.run(self.client.settle_plan(timeout), self._resource)
+
+    async def take_screenshot(self, image_name):
+        return await self._call(self.client.take_screenshot, image_name)
+
+    def reuse_screenshot(self, screenshot: Screenshot, image_name, step=None):
+        return self.client.reuse_screenshot(screenshot, image_name, step)
+
+    async def start_screenrecord(self):
+        with span("client.start_screenrecord", "client"):
+            try:
+                await self._call(self.client.driver.start_recording_screen)
+                await self.wait_for_settle()
+                return True
+            except Exception as e:
+                logging.info(f"start screenrecord error: {str(e)}")
+                return False
+
+    async def stop_screenrecord(self, case_name, file_format='mp4'):
+        return await self._call(self.client.stop_screenrecord, case_name, file_format)
+
+    async def flush_records(self):
+        # waits for the records writer, it does not use the appium server
+        return await self._runtime.offload(self.client.flush_records)
+
+    async def touch_at_coordinate(self, coordinate: Coordinate):
+        return await self._call(self.client.touch_at_coordinate, coordinate)
+
+    async def long_press_at_coordinate(self, coordinate: Coordinate, duration=1000):
+        return await self._call(self.client.long_press_at_coordinate, coordinate, duration)
+
+    async def swipe_from_coordinate(self, from_coordinate: Coordinate, to_coordinate: Coordinate, duration=500):
+        return await self._call(self.client.swipe_from_coordinate, from_coordinate, to_coordinate, duration)
+
+    async def multi_swipe(self, paths, duration=500):
+        return await self._call(self.client.multi_swipe, paths, duration)
+
+    async def send_keys(self, coordinate: Coordinate, content):
+        return await self._call(self.client.send_keys, coordinate, content)
+
+    async def is_alive(self):
+        return await self._call(self.client.is_alive)
+
+    async def quit(self):
+        return await self._call(self.client.quit)
+
 class AndroidClient(Client):
-    def __init__(self, run_path: str, config: config.Config, dontStopAppOnReset: bool = False):
+    def __init__(self, run_path: str, config: config.Config, dontStopAppOnReset: bool = False, device: config.DeviceConfig = None):
         logging.info(f"initialize Android client: app_package: {config.app_package}, app_activity: {config.app_activity}")
         caps = {
             "platformName": DevicePlatform.ANDROID,
@@ -127,13 +448,21 @@ class AndroidClient(Client):
             "sessionOverride": True,
             "dontStopAppOnReset": dontStopAppOnReset
         }
+        appium_server_host = config.appium_server_host
+        if device is not None:
+            logging.info(f"initialize Android client on device: {device.name}")
+            appium_server_host = device.appium_server_host
+            if device.udid:
+                caps["udid"] = device.udid
+            if device.system_port:
+                caps["systemPort"] = device.system_port
 
         try:
             driver = webdriver.Remote(
-                command_executor=config.appium_server_host,
+                command_executor=appium_server_host,
                 options=UiAutomator2Options().load_capabilities(caps)
             )
-            super().__init__(run_path, driver)
+            super().__init__(run_path, driver, records.get_store(config, run_path), config)
             logging.info("initialize android client success")
         except Exception as e:
             logging.info(f"init Android client failed: {str(e)}")
@@ -141,13 +470,18 @@ class AndroidClient(Client):
 
 
 class IOSClient(Client):
-    def __init__(self, run_path: str, config: config.Config):
+    def __init__(self, run_path: str, config: config.Config, device: config.DeviceConfig = None):
         # confing device capabilities
         desired_caps = {
         }
+        appium_server_host = config.appium_server_host
+        if device is not None:
+            appium_server_host = device.appium_server_host
+            if device.udid:
+                desired_caps["udid"] = device.udid
         try:
-            driver = webdriver.Remote(config.appium_server_host, desired_caps)
-            super().__init__(run_path, driver)
+            driver = webdriver.Remote(appium_server_host, desired_caps)
+            super().__init__(run_path, driver, records.get_store(config, run_path), config)
             logging.info("initialize iOS client success")
         except Exception as e:
             logging.info(f"init iOS client failed: {str(e)}")
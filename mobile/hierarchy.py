@@ -0,0 +1,83 @@
+import re
+import logging
+import difflib
+import xml.etree.ElementTree as ET
+
+ANDROID_BOUNDS = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+# attributes that hold the visible text or the accessibility label of an element
+LABEL_ATTRIBUTES = ("text", "content-desc", "resource-id", "name", "label", "value")
+# a fuzzy match must score this much higher than the next label to be taken
+FUZZY_MARGIN = 0.05
+
+def _normalize(label):
+    # "com.example.app:id/login_button" -> "login button"
+    label = label.split(":id/")[-1]
+    return " ".join(re.sub(r"[_\-]+", " ", label).lower().split())
+
+def _key(label):
+    # the words and digits of a normalized label without any separator, "Log-in!" and "login" share a key
+    # while "login" and "logins" or "page 10" and "page 11" do not
+    return re.sub(r"[\W_]+", "", label)
+
+def _bounds(element):
+    bounds = element.get("bounds")
+    if bounds is not None:
+        match = ANDROID_BOUNDS.fullmatch(bounds.strip())
+        if match is None:
+            return None
+        x1, y1, x2, y2 = (int(value) for value in match.groups())
+        return x1, y1, x2, y2
+    if element.get("x") is not None and element.get("width") is not None:
+        x, y = int(float(element.get("x"))), int(float(element.get("y")))
+        return x, y, x + int(float(element.get("width"))), y + int(float(element.get("height")))
+    return None
+
+# index of the appium page source, maps element labels to their bounds
+class HierarchyIndex:
+    def __init__(self, page_source: str):
+        # normalized label -> list of (x1, y1, x2, y2)
+        self._labels = {}
+        # key -> normalized labels of that key, see _key
+        self._keys = {}
+        try:
+            root = ET.fromstring(page_source)
+        except ET.ParseError as e:
+            logging.info(f"parse page source failed: {str(e)}")
+            return
+        for element in root.iter():
+            if element.get("displayed") == "false" or element.get("visible") == "false":
+                continue
+            bounds = _bounds(element)
+            if bounds is None or bounds[2] <= bounds[0] or bounds[3] <= bounds[1]:
+                continue
+            for attribute in LABEL_ATTRIBUTES:
+                value = element.get(attribute)
+                if value and value.strip():
+                    label = _normalize(value)
+                    self._labels.setdefault(label, []).append(bounds)
+                    self._keys.setdefault(_key(label), set()).add(label)
+
+    def find(self, query, threshold=0.85):
+        # returns the center pixel of the only element matching the query, or None if there is no confident hit
+        query = _normalize(query)
+        if not query:
+            return None
+        candidates = self._labels.get(query)
+        if candidates is None:
+            # only labels that differ from the query in case, punctuation or whitespace are fuzzy matches,
+            # a different word or number is another element and is left to the locate model
+            scores = [(difflib.SequenceMatcher(None, query, label).ratio(), label) for label in self._keys.get(_key(query), ())]
+            scores = [(score, label) for score, label in scores if score >= threshold]
+            if not scores:
+                return None
+            scores.sort(reverse=True)
+            # two different labels that match about equally well are ambiguous
+            if len(scores) > 1 and scores[0][0] - scores[1][0] < FUZZY_MARGIN:
+                return None
+            candidates = self._labels[scores[0][1]]
+
+        # the same label may be set on an element and its parent, they are the same target if nested
+        x1, y1, x2, y2 = min(candidates, key=lambda bounds: (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]))
+        if any(not (bounds[0] <= x1 and bounds[1] <= y1 and bounds[2] >= x2 and bounds[3] >= y2) for bounds in candidates):
+            return None
+        return (x1 + x2) / 2, (y1 + y2) / 2
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import queue
+import hashlib
+import logging
+import threading
+import contextvars
+from io import BytesIO
+from collections import Counter
+from contextlib import contextmanager
+from PIL import Image
+from config import Config
+
+# run record tasks in background threads, so hashing, encoding and disk io stay off the step execution path
+class RecordWriter:
+    def __init__(self, threads=1):
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._work, name=f"record-writer-{index}", daemon=True) for index in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def flush(self):
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.info(f"record saved failed, error: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+# the file, case, device and step the records of a thread or an asyncio task belong to
+_context = contextvars.ContextVar("records_context", default={})
+
+@contextmanager
+def context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def set_step(index):
+    # the step of the records taken from now on, until the surrounding context ends
+    _context.set({**_context.get(), "step": index})
+
+def current_key(**fields):
+    return {**_context.get(), **fields}
+
+# records of all runs, every image and screenrecord is stored once in blobs/ under the hash of its content,
+# and every run has a manifest in runs/ that maps its cases and steps to the blobs
+class RecordStore:
+    def __init__(self, path, image_format="webp", max_bytes=0, max_age=0, writer_threads=2):
+        self.path = path
+        # webp is lossless and several times smaller than the png of appium, png keeps the bytes of appium as they are
+        self.image_format = image_format
+        # retention of the runs, 0 is unlimited, see prune
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.run_id = None
+        self._run = None
+        self._lock = threading.Lock()
+        # blobs known to exist, so repeated screens are not even checked on disk
+        self._known = set()
+        self._writer = RecordWriter(writer_threads)
+
+    def begin_run(self):
+        with self._lock:
+            self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+            self._run = {"run": self.run_id, "started_at": time.time(), "records": []}
+        return self.run_id
+
+    def record(self, data, key, extension=None):
+        # data is png bytes or a PIL image, or the bytes of a file of the given extension, e.g. a screenrecord
+        self._writer.submit(self._put, data, key, extension, time.time())
+
+    def flush(self):
+        self._writer.flush()
+
+    def _put(self, data, key, extension, recorded_at):
+        extension = extension or self.image_format
+        if isinstance(data, Image.Image):
+            digest = hashlib.sha256(f"{data.mode}{data.size}".encode("utf-8") + data.tobytes()).hexdigest()
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+        blob = f"{digest[:2]}/{digest}.{extension}"
+        blob_path = os.path.join(self.path, "blobs", blob)
+        if blob not in self._known and not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # the blob appears complete or not at all, also when two writers store the same content
+            temp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(self._encode(data, extension))
+            os.replace(temp_path, blob_path)
+            logging.debug(f"record saved successfully, path: {blob_path}")
+        self._known.add(blob)
+        with self._lock:
+            if self._run is not None:
+                self._run["records"].append({**key, "blob": blob, "time": round(recorded_at, 3)})
+
+    def _encode(self, data, extension):
+        if extension not in ("webp", "png"):
+            return data
+        if extension == "png" and not isinstance(data, Image.Image):
+            return data
+        image = data if isinstance(data, Image.Image) else Image.open(BytesIO(data))
+        buffer = BytesIO()
+        if extension == "webp":
+            image.save(buffer, format="WEBP", lossless=True)
+        else:
+            image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def end_run(self, summary=None):
+        # writes the manifest of the run and applies the retention, returns the manifest path
+        self.flush()
+        with self._lock:
+            run, self._run = self._run, None
+        if run is None:
+            return None
+        run["finished_at"] = time.time()
+        if summary is not None:
+            run["summary"] = summary
+        manifest_path = os.path.join(self.path, "runs", f"{run['run']}.json")
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+        self.prune(keep=run["run"])
+        return manifest_path
+
+    def _manifests(self):
+        # (run id, path, finished at, blobs) of every run, oldest first
+        runs_path = os.path.join(self.path, "runs")
+        if not os.path.isdir(runs_path):
+            return []
+        manifests = []
+        for name in sorted(os.listdir(runs_path)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(runs_path, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    run = json.load(f)
+            except Exception as e:
+                logging.warning(f"records manifest is unreadable, skip it: {path}, error: {str(e)}")
+                continue
+            manifests.append((run["run"], path, run.get("finished_at", 0.0), {record["blob"] for record in run["records"]}))
+        return manifests
+
+    def prune(self, keep=None):
+        # runs older than max_age are dropped, then the oldest runs until the blobs fit in max_bytes,
+        # blobs no run refers to any more are deleted, the run given by keep is never dropped
+        if not self.max_bytes and not self.max_age:
+            return
+        manifests = self._manifests()
+        blobs_path = os.path.join(self.path, "blobs")
+        sizes = {}
+        if os.path.isdir(blobs_path):
+            for directory in os.listdir(blobs_path):
+                for name in os.listdir(os.path.join(blobs_path, directory)):
+                    if not name.endswith(".tmp"):
+                        sizes[f"{directory}/{name}"] = os.path.getsize(os.path.join(blobs_path, directory, name))
+
+        references = Counter(blob for _, _, _, blobs in manifests for blob in blobs)
+        total = sum(sizes.get(blob, 0) for blob in references)
+        now = time.time()
+        dropped = []
+        for run_id, path, finished_at, blobs in manifests:
+            if run_id == keep:
+                continue
+            expired = self.max_age and now - finished_at > self.max_age
+            oversized = self.max_bytes and total > self.max_bytes
+            if not expired and not oversized:
+                continue
+            os.remove(path)
+            dropped.append(run_id)
+            references.subtract(blobs)
+            total -= sum(sizes.get(blob, 0) for blob in blobs if references[blob] <= 0)
+
+        removed = 0
+        for blob, size in sizes.items():
+            if references[blob] <= 0:
+                os.remove(os.path.join(blobs_path, blob))
+                self._known.discard(blob)
+                removed += size
+        if dropped or removed:
+            logging.info(f"records pruned, runs: {len(dropped)}, freed: {removed / 1024 / 1024:.1f}MB, kept: {total / 1024 / 1024:.1f}MB")
+
+_lock = threading.Lock()
+_stores = {}
+
+def get_store(config: Config, run_path) -> RecordStore:
+    # every client of a run path shares one store, so a screen seen by several devices is written once
+    path = os.path.join(run_path, "records")
+    with _lock:
+        if path not in _stores:
+            _stores[path] = RecordStore(path, config.records_image_format, config.records_max_size_mb * 1024 * 1024, config.records_max_age_days * 24 * 3600)
+        return _stores[path]
@@ -0,0 +1,88 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+
+HASH_SIZE = 8
+HASH_IMAGE_SIZE = 32
+
+def _dct_matrix(size):
+    matrix = np.zeros((size, size))
+    for k in range(size):
+        for n in range(size):
+            matrix[k, n] = np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+    matrix[0] *= np.sqrt(1 / size)
+    matrix[1:] *= np.sqrt(2 / size)
+    return matrix
+
+_DCT = _dct_matrix(HASH_IMAGE_SIZE)
+
+def perceptual_hash(image: Image.Image) -> int:
+    # 64 bit pHash: the signs of the lowest DCT frequencies of a 32x32 gray image compared to their median
+    pixels = np.asarray(image.convert("L").resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    frequencies = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = frequencies > np.median(frequencies[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+# persistent cache of locate results, keyed by the perceptual hash of the screenshot and the query
+class LocateCache:
+    def __init__(self, path, tolerance=4, max_entries=1000):
+        self._path = path
+        self._tolerance = tolerance
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # (image hash, query) -> (x ratio, y ratio), ordered from least to most recently used
+        self._entries = OrderedDict()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS locate_cache (image_hash TEXT, query TEXT, x_ratio REAL, y_ratio REAL, last_used REAL, PRIMARY KEY (image_hash, query))")
+        self._db.commit()
+        for image_hash, query, x_ratio, y_ratio in self._db.execute("SELECT image_hash, query, x_ratio, y_ratio FROM locate_cache ORDER BY last_used"):
+            self._entries[(int(image_hash, 16), query)] = (x_ratio, y_ratio)
+        self._evict()
+        self._db.commit()
+        logging.info(f"locate cache loaded, path: {path}, entries: {len(self._entries)}")
+
+    def get(self, image_hash, query):
+        with self._lock:
+            best_key, best_distance = None, self._tolerance + 1
+            for key in self._entries:
+                if key[1] != query:
+                    continue
+                distance = hamming_distance(key[0], image_hash)
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+                    if distance == 0:
+                        break
+            if best_key is None:
+                return None
+
+            self._entries.move_to_end(best_key)
+            self._db.execute("UPDATE locate_cache SET last_used = ? WHERE image_hash = ? AND query = ?", (time.time(), f"{best_key[0]:016x}", query))
+            self._db.commit()
+            logging.info(f"locate cache hit, query: {query}, hamming distance: {best_distance}")
+            return self._entries[best_key]
+
+    def put(self, image_hash, query, x_ratio, y_ratio):
+        with self._lock:
+            self._entries[(image_hash, query)] = (x_ratio, y_ratio)
+            self._entries.move_to_end((image_hash, query))
+            self._db.execute("INSERT OR REPLACE INTO locate_cache VALUES (?, ?, ?, ?, ?)", (f"{image_hash:016x}", query, x_ratio, y_ratio, time.time()))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while len(self._entries) > self._max_entries:
+            (image_hash, query), _ = self._entries.popitem(last=False)
+            self._db.execute("DELETE FROM locate_cache WHERE image_hash = ? AND query = ?", (f"{image_hash:016x}", query))
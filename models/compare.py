@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import yaml
+import logging
+import argparse
+import dataclasses
+import config
+from mobile.client import Screenshot
+from models.locate import LocalLocate
+
+# check that the locate coordinates of a local model backend stay close to the fp32 reference
+# samples.yml in the samples directory lists the screenshots and queries:
+# samples:
+#   - image: home.png
+#     query: login button
+def compare(conf: config.Config, samples_path, backend, tolerance):
+    with open(os.path.join(samples_path, "samples.yml"), "r", encoding="utf-8") as f:
+        samples = yaml.safe_load(f)["samples"]
+
+    # the cache would hide the difference between the two backends, and the worker pool is one process wide
+    # singleton that keeps the backend of the first config, both models run in this process instead
+    reference = LocalLocate(dataclasses.replace(conf, local_model_backend="fp32", locate_cache_enabled=False,
+                                                local_model_workers=0, local_model_worker_address=""), samples_path)
+    candidate = LocalLocate(dataclasses.replace(conf, local_model_backend=backend, locate_cache_enabled=False,
+                                                local_model_workers=0, local_model_worker_address=""), samples_path)
+
+    failed = 0
+    durations = {"fp32": 0.0, backend: 0.0}
+    for sample in samples:
+        with open(os.path.join(samples_path, sample["image"]), "rb") as image_file:
+            screenshot = Screenshot(image_file.read())
+
+        started_at = time.time()
+        expected = reference._locate_ratio(sample["query"], screenshot)
+        durations["fp32"] += time.time() - started_at
+        started_at = time.time()
+        actual = candidate._locate_ratio(sample["query"], screenshot)
+        durations[backend] += time.time() - started_at
+
+        # the deviation is measured in screenshot pixels
+        width, height = screenshot.image.size
+        deviation = max(abs(expected.x_ratio - actual.x_ratio) * width, abs(expected.y_ratio - actual.y_ratio) * height)
+        if deviation > tolerance:
+            failed += 1
+            logging.error(f"sample {sample['image']} 【{sample['query']}】 deviation {deviation:.1f}px is out of tolerance {tolerance}px")
+        else:
+            logging.info(f"sample {sample['image']} 【{sample['query']}】 deviation {deviation:.1f}px")
+
+    for name, duration in durations.items():
+        logging.info(f"backend {name}: {duration / max(len(samples), 1):.2f}s per locate")
+    logging.info(f"compare finished: total {len(samples)}, out of tolerance {failed}")
+    return failed == 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Compare a local model backend with fp32 on a sample set', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--config-file', type=str, metavar='', default='config.yml', help='\nConfiguration file path, default: ./config.yml')
+    parser.add_argument('--samples', type=str, metavar='', required=True, help='\nSample directory path, contains samples.yml and the screenshots')
+    parser.add_argument('--backend', type=str, metavar='', required=True, help='\nLocal model backend to check, support: bf16, int8')
+    parser.add_argument('--tolerance', type=float, metavar='', default=10, help='\nMax deviation in pixels, default: 10')
+    args = parser.parse_args()
+
+    if not compare(config.load_config(args.config_file), args.samples, args.backend, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,182 @@
+import copy
+import torch
+import logging
+from transformers import DynamicCache
+from qwen_vl_utils import process_vision_info
+
+VISION_START = "<|vision_start|>"
+IMAGE_PAD = "<|image_pad|>"
+PLACEHOLDER = "<|placeholder|>"
+
+# run a Qwen2-VL model on messages that all start with the same prompt,
+# the kv cache of the prompt is computed once and reused by every call
+class PrefixInference:
+    def __init__(self, model, processor):
+        self._model = model
+        self._processor = processor
+        self._prefix_text = None
+        self._prefix_ids = None
+        self._prefix_cache = None
+        eos_token_id = model.generation_config.eos_token_id
+        self._eos_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+
+    def prepare(self, messages_list, shared_image=False):
+        # messages_list holds one conversation per sequence of the batch,
+        # with shared_image all conversations show the same image and it is encoded only once
+        texts = [self._processor.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True,
+        ) for messages in messages_list]
+        image_inputs, _ = process_vision_info(messages_list[0] if shared_image else messages_list)
+        vision = self._processor.image_processor(images=image_inputs, return_tensors="pt") if image_inputs else {}
+
+        # everything before the image is the constant part of the prompt
+        prefix_text = texts[0][:texts[0].index(VISION_START)] if VISION_START in texts[0] else ""
+        if any(not text.startswith(prefix_text) for text in texts):
+            prefix_text = ""
+        self._update_prefix(prefix_text)
+
+        # expand every image pad to the number of visual tokens of its image, like the processor does
+        merge_length = self._processor.image_processor.merge_size ** 2
+        image_index = 0
+        suffixes = []
+        for text in texts:
+            suffix = text[len(prefix_text):]
+            while IMAGE_PAD in suffix:
+                grid_thw = vision["image_grid_thw"][0 if shared_image else image_index]
+                suffix = suffix.replace(IMAGE_PAD, PLACEHOLDER * (grid_thw.prod().item() // merge_length), 1)
+                image_index += 1
+            suffixes.append(suffix.replace(PLACEHOLDER, IMAGE_PAD))
+
+        # the suffixes are padded on the left, so the cached prefix stays at the start of every sequence
+        suffix_ids = self._processor.tokenizer(suffixes, add_special_tokens=False).input_ids
+        suffix_length = max(len(ids) for ids in suffix_ids)
+        pad_token_id = self._processor.tokenizer.pad_token_id
+        batch_size = len(texts)
+        prefix_length = self._prefix_ids.shape[1]
+        input_ids = torch.cat([
+            self._prefix_ids.cpu().expand(batch_size, -1),
+            torch.tensor([[pad_token_id] * (suffix_length - len(ids)) + ids for ids in suffix_ids]),
+        ], dim=1)
+        attention_mask = torch.cat([
+            torch.ones((batch_size, prefix_length), dtype=torch.long),
+            torch.tensor([[0] * (suffix_length - len(ids)) + [1] * len(ids) for ids in suffix_ids]),
+        ], dim=1)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "prefix_length": prefix_length, "image_repeat": 1}
+        if image_inputs:
+            inputs["pixel_values"] = vision["pixel_values"]
+            inputs["vision_grid_thw"] = vision["image_grid_thw"]
+            # the rope index needs the grid of every image occurrence in the batch
+            inputs["image_grid_thw"] = vision["image_grid_thw"].repeat(image_index, 1) if shared_image else vision["image_grid_thw"]
+            inputs["image_repeat"] = image_index if shared_image else 1
+        return {key: value.to(self._model.device) if torch.is_tensor(value) else value for key, value in inputs.items()}
+
+    def _update_prefix(self, prefix_text):
+        if prefix_text == self._prefix_text:
+            return
+        self._prefix_text = prefix_text
+        self._prefix_ids = self._processor.tokenizer(prefix_text, add_special_tokens=False, return_tensors="pt").input_ids.to(self._model.device)
+        self._prefix_cache = DynamicCache()
+        prefix_length = self._prefix_ids.shape[1]
+        if prefix_length == 0:
+            return
+        position_ids = torch.arange(prefix_length, device=self._model.device).view(1, 1, -1).expand(3, 1, -1)
+        with torch.no_grad():
+            self._model.model(
+                input_ids=self._prefix_ids,
+                position_ids=position_ids,
+                past_key_values=self._prefix_cache,
+                use_cache=True,
+                cache_position=torch.arange(prefix_length, device=self._model.device),
+            )
+        logging.info(f"prompt prefix cached, tokens: {prefix_length}")
+
+    def _embed(self, input_ids, inputs):
+        model = self._model
+        inputs_embeds = model.model.embed_tokens(input_ids)
+        if "pixel_values" in inputs:
+            pixel_values = inputs["pixel_values"].type(model.visual.get_dtype())
+            image_embeds = model.visual(pixel_values, grid_thw=inputs["vision_grid_thw"])
+            if inputs["image_repeat"] > 1:
+                image_embeds = image_embeds.repeat(inputs["image_repeat"], 1)
+            image_mask = (input_ids == model.config.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+            inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds.to(inputs_embeds.dtype))
+        return inputs_embeds
+
+    def _forward(self, inputs_embeds, position_ids, attention_mask, cache, cache_position):
+        outputs = self._model.model(
+            inputs_embeds=inputs_embeds,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=cache_position,
+        )
+        # only the logits of the last position are needed
+        return self._model.lm_head(outputs[0][:, -1, :]).float()
+
+    def prefill(self, inputs):
+        # returns the logits of the next token, and the state to continue decoding
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        position_ids, rope_deltas = self._model.get_rope_index(input_ids, inputs.get("image_grid_thw"), None, attention_mask)
+
+        prefix_length = inputs["prefix_length"]
+        cache = copy.deepcopy(self._prefix_cache) if prefix_length > 0 else DynamicCache()
+        if prefix_length > 0 and input_ids.shape[0] > 1:
+            cache.batch_repeat_interleave(input_ids.shape[0])
+        suffix_ids = input_ids[:, prefix_length:]
+        logits = self._forward(
+            self._embed(suffix_ids, inputs),
+            position_ids[:, :, prefix_length:],
+            attention_mask,
+            cache,
+            torch.arange(prefix_length, input_ids.shape[1], device=input_ids.device),
+        )
+        return logits, (cache, attention_mask, rope_deltas)
+
+    def next_token_logits(self, inputs):
+        with torch.no_grad():
+            logits, _ = self.prefill(inputs)
+        return logits
+
+    def answer_confidences(self, inputs, positive_ids, negative_ids):
+        # probability of the positive answer against the negative one, decided by the first generated token
+        logits = self.next_token_logits(inputs)
+        positive = torch.logsumexp(logits[:, positive_ids], dim=1)
+        negative = torch.logsumexp(logits[:, negative_ids], dim=1)
+        return torch.sigmoid(positive - negative).tolist()
+
+    def generate(self, inputs, max_new_tokens=128):
+        # greedy decoding, the same as the generation config of ShowUI and Qwen2-VL
+        with torch.no_grad():
+            logits, (cache, attention_mask, rope_deltas) = self.prefill(inputs)
+            batch_size = logits.shape[0]
+            generated = []
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=logits.device)
+            for _ in range(max_new_tokens):
+                next_ids = logits.argmax(dim=-1)
+                generated.append(next_ids)
+                finished |= torch.tensor([token_id in self._eos_ids for token_id in next_ids.tolist()], device=logits.device)
+                if finished.all():
+                    break
+
+                cache_length = attention_mask.shape[1]
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=1)
+                position_ids = (rope_deltas + cache_length).view(1, batch_size, 1).expand(3, -1, -1)
+                logits = self._forward(
+                    self._model.model.embed_tokens(next_ids.unsqueeze(-1)),
+                    position_ids,
+                    attention_mask,
+                    cache,
+                    torch.tensor([cache_length], device=logits.device),
+                )
+
+        # drop everything after the first eos of every sequence
+        sequences = []
+        for row in torch.stack(generated, dim=1).tolist():
+            end = next((index for index, token_id in enumerate(row) if token_id in self._eos_ids), len(row))
+            sequences.append(row[:end])
+        return self._processor.batch_decode(
+            sequences, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
@@ -1,19 +1,21 @@
-import base64
 import os
 import ast
-import torch
+import asyncio
+import weakref
+import threading
+import plan
 from config import Config
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image, ImageDraw
-from mobile.client import Coordinate
-from qwen_vl_utils import process_vision_info
-from huggingface_hub import hf_hub_download, list_repo_files
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+from mobile.client import Coordinate, Screenshot
+from models.cache import LocateCache, perceptual_hash
+from models import transport, workers
+from models.preprocess import ImagePreprocessor
+from tracing import span, tracer
 
-MODEL_REPO = "showlab/ShowUI-2B"
-DESTINATION_FOLDER = "./showui-2b"
 LOCATE_PROMPT = "Based on the screenshot of the page, I give a text description and you give its corresponding location. The coordinate represents a clickable location [x, y] for an element, which is a relative coordinate on the screenshot, scaled from 0 to 1."   
 
 class RatioCoordinate:
@@ -25,12 +27,23 @@ class RatioCoordinate:
         return Coordinate(x_pixel=device_pixel_config[0] * self.x_ratio, y_pixel=device_pixel_config[1] * self.y_ratio)
 
 class Locate:
-    def __init__(self, config: Config, run_path):
+    def __init__(self, config: Config, run_path, cache: LocateCache = None):
         self._device_pixel_config = (config.device_width, config.device_height)
         self._run_path = run_path
         logging.info(f"Project absolute path: {self._run_path}")
+        self._hierarchy_enabled = config.hierarchy_enabled
+        self._hierarchy_threshold = config.hierarchy_threshold
+        # a backend wrapping another one takes over its cache, see TemplateLocate
+        self._cache = cache
+        if cache is None and config.locate_cache_enabled:
+            cache_path = config.locate_cache_path if os.path.isabs(config.locate_cache_path) else os.path.join(run_path, config.locate_cache_path)
+            self._cache = LocateCache(cache_path, config.locate_cache_tolerance, config.locate_cache_max_entries)
+        # screenshot -> (image hash, query, ratio coordinate) answered by the model on it, cached once its step passes,
+        # a thrown away prefetch or a failed step is forgotten with its screenshot
+        self._uncached = weakref.WeakKeyDictionary()
+        self._uncached_lock = threading.Lock()
     
-    def _locate_ratio(self, query) -> RatioCoordinate:
+    def _locate_ratio(self, query, screenshot: Screenshot) -> RatioCoordinate:
         pass
     
     def _draw_point(self, image_input, point=None, radius=5):
@@ -44,119 +57,263 @@ class Locate:
             ImageDraw.Draw(image).ellipse((x - radius, y - radius, x + radius, y + radius), fill='red')
         return image
     
-    def locate_pixel(self, query):
-        ratio_coordinate = self._locate_ratio(query)
-        coordinate = ratio_coordinate.to_pixel(self._device_pixel_config)
-        logging.info(f"The location pixel is: {coordinate.x_pixel}, {coordinate.y_pixel}")
-        return coordinate
+    def _locate_ratios(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        # backends that can resolve several queries on one screenshot at once override this
+        return [self._locate_ratio(query, screenshot) for query in queries]
+
+    def locate_pixel(self, query, screenshot: Screenshot, device_pixel_config=None):
+        return self.locate_many(screenshot, [query], device_pixel_config)[0]
+
+    def learn(self, screenshot: Screenshot):
+        # the step located on the screenshot passed, its model answers are cached
+        with self._uncached_lock:
+            located = self._uncached.pop(screenshot, [])
+        for image_hash, query, ratio_coordinate in located:
+            self._cache.put(image_hash, query, ratio_coordinate.x_ratio, ratio_coordinate.y_ratio)
+
+    def locate_many(self, screenshot: Screenshot, queries, device_pixel_config=None):
+        return plan.run(self.locate_plan(screenshot, queries, device_pixel_config))
+
+    def locate_plan(self, screenshot: Screenshot, queries, device_pixel_config=None, locate_ratios=None):
+        # locate_many as a plan, see plan.py, the queries the page source and the cache cannot resolve go to
+        # locate_ratios, AsyncLocate gives its awaitable model requests
+        # the locate model can be shared by several devices, so the device size is given per call
+        device_pixel_config = device_pixel_config or self._device_pixel_config
+        locate_ratios = locate_ratios or self._locate_ratios
+        ratio_coordinates, image_hash = yield plan.Offload(self._known_ratios, screenshot, queries, device_pixel_config)
+        missing = [index for index, ratio_coordinate in enumerate(ratio_coordinates) if ratio_coordinate is None]
+        if missing:
+            with span("locate.model", "locate", queries=len(missing)):
+                located = yield locate_ratios([queries[index] for index in missing], screenshot)
+            yield plan.Offload(self._fill, screenshot, queries, ratio_coordinates, missing, located, image_hash)
+        return (yield plan.Offload(self._mark, screenshot, ratio_coordinates, device_pixel_config))
+
+    def _known_ratios(self, screenshot: Screenshot, queries, device_pixel_config):
+        # the queries resolved without the model, from the page source or the cache, the others are None
+        ratio_coordinates = [None] * len(queries)
+        image_hash = None
+        if self._hierarchy_enabled:
+            with span("locate.hierarchy", "locate"):
+                ratio_coordinates = self._locate_hierarchy(queries, screenshot, device_pixel_config)
+        if self._cache is not None and None in ratio_coordinates:
+            image_hash = perceptual_hash(screenshot.image)
+            for index, query in enumerate(queries):
+                if ratio_coordinates[index] is not None:
+                    continue
+                cached = self._cache.get(image_hash, query)
+                if cached is not None:
+                    ratio_coordinates[index] = RatioCoordinate(x_ratio=cached[0], y_ratio=cached[1])
+        return ratio_coordinates, image_hash
+
+    def _fill(self, screenshot: Screenshot, queries, ratio_coordinates, missing, located, image_hash):
+        for index, ratio_coordinate in zip(missing, located):
+            ratio_coordinates[index] = ratio_coordinate
+        if self._cache is not None:
+            with self._uncached_lock:
+                self._uncached.setdefault(screenshot, []).extend((image_hash, queries[index], ratio_coordinates[index]) for index in missing)
+
+    def _mark(self, screenshot: Screenshot, ratio_coordinates, device_pixel_config):
+        # every located point is drawn on one copy of the screenshot
+        marked_image = screenshot.image.copy()
+        coordinates = []
+        for ratio_coordinate in ratio_coordinates:
+            self._draw_point(marked_image, (ratio_coordinate.x_ratio, ratio_coordinate.y_ratio))
+            coordinate = ratio_coordinate.to_pixel(device_pixel_config)
+            logging.info(f"The location pixel is: {coordinate.x_pixel}, {coordinate.y_pixel}")
+            coordinates.append(coordinate)
+        screenshot.save(marked_image)
+        return coordinates
+
+    def _locate_hierarchy(self, queries, screenshot: Screenshot, device_pixel_config):
+        # elements whose text, content-desc or resource-id match the query need no model inference
+        ratio_coordinates = [None] * len(queries)
+        try:
+            hierarchy = screenshot.hierarchy
+        except Exception as e:
+            logging.info(f"get page source failed: {str(e)}")
+            return ratio_coordinates
+        if hierarchy is None:
+            return ratio_coordinates
+        for index, query in enumerate(queries):
+            center = hierarchy.find(query, self._hierarchy_threshold)
+            if center is not None:
+                logging.info(f"locate 【{query}】 from the page source")
+                ratio_coordinates[index] = RatioCoordinate(x_ratio=center[0] / device_pixel_config[0], y_ratio=center[1] / device_pixel_config[1])
+        return ratio_coordinates
 
 class LocalLocate(Locate):
     def __init__(self, config: Config, run_path):
         super().__init__(config, run_path)
         logging.info("LocalLocate initialized completely. ")
 
-        os.makedirs(DESTINATION_FOLDER, exist_ok=True)
-        files = list_repo_files(repo_id=MODEL_REPO)
-        for file in files:
-            file_path = hf_hub_download(repo_id=MODEL_REPO, filename=file, local_dir=DESTINATION_FOLDER)
-            print(f"Downloaded {file} to {file_path}")
-
-        # load pretrained model
-        model = Qwen2VLForConditionalGeneration.from_pretrained(
-            DESTINATION_FOLDER,
-            torch_dtype=torch.float32,
-            device_map="cpu",
-            low_cpu_mem_usage=True,
-        )
-
-        # load tokenizer and processor
-        processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-2B-Instruct")
-        self._model = model
-        self._processor = processor
-
-    def _locate_ratio(self, query) -> RatioCoordinate:
-        messages = [
+        # two stage locate: a low resolution pass, then a native resolution pass on a crop around its answer
+        self._two_stage = config.locate_two_stage
+        self._coarse_max_side = config.locate_coarse_max_side
+        self._crop_ratio = config.locate_crop_ratio
+
+        # the model runs in worker processes, they are shared by all device threads and loaded only once
+        self._workers = None
+        if config.local_model_workers > 0 or config.local_model_worker_address:
+            self._workers = workers.get_workers(config, run_path)
+            return
+
+        # torch and transformers are only imported in local mode, remote runners do not install them
+        from models import registry
+        from models.inference import PrefixInference
+
+        # the model and processor are shared with LocalValidate when both use the same repo
+        shared_model = registry.load_shared_model(config.locate_model_repo, config.local_model_backend, config.local_model_threads)
+        self._model = shared_model.model
+        self._processor = shared_model.processor
+        self._lock = shared_model.lock
+        # the kv cache of LOCATE_PROMPT is computed once and reused by every locate
+        self._inference = PrefixInference(self._model, self._processor)
+
+    def _locate_ratio(self, query, screenshot: Screenshot) -> RatioCoordinate:
+        return self._locate_ratios([query], screenshot)[0]
+
+    def _locate_ratios(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        if self._workers is not None:
+            return [RatioCoordinate(x_ratio=x, y_ratio=y) for x, y in self._workers.locate(queries, screenshot)]
+        with self._lock:
+            return self._locate_ratios_locked(queries, screenshot)
+
+    def _locate_ratios_locked(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        image = screenshot.image
+        if not self._two_stage or max(image.size) <= self._coarse_max_side:
+            # one conversation per query, the image is encoded once and all queries are decoded in one batch
+            return self._generate_ratios([self._messages(query, image) for query in queries], shared_image=True)
+
+        # a low resolution pass finds the region, far fewer visual tokens than the full screen
+        scale = self._coarse_max_side / max(image.size)
+        coarse_image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.LANCZOS)
+        coarse = self._generate_ratios([self._messages(query, coarse_image) for query in queries], shared_image=True)
+
+        # the crop around every coarse point is asked again at native resolution
+        boxes = [self._crop_box(ratio_coordinate, image.size) for ratio_coordinate in coarse]
+        fine = self._generate_ratios([self._messages(query, image.crop(box)) for query, box in zip(queries, boxes)], strict=False)
+
+        ratio_coordinates = []
+        for query, coarse_ratio, fine_ratio, (left, top, right, bottom) in zip(queries, coarse, fine, boxes):
+            if fine_ratio is None or not (0 <= fine_ratio.x_ratio <= 1 and 0 <= fine_ratio.y_ratio <= 1):
+                logging.info(f"refine 【{query}】 failed, use the coarse location")
+                ratio_coordinates.append(coarse_ratio)
+                continue
+            x = (left + fine_ratio.x_ratio * (right - left)) / image.width
+            y = (top + fine_ratio.y_ratio * (bottom - top)) / image.height
+            logging.info(f"locate 【{query}】 coarse: [{coarse_ratio.x_ratio:.3f}, {coarse_ratio.y_ratio:.3f}], refined: [{x:.3f}, {y:.3f}]")
+            ratio_coordinates.append(RatioCoordinate(x_ratio=x, y_ratio=y))
+        return ratio_coordinates
+
+    def _generate_ratios(self, messages_list, shared_image=False, strict=True) -> list[RatioCoordinate]:
+        output_texts = self._inference.generate(self._inference.prepare(messages_list, shared_image=shared_image), max_new_tokens=128)
+
+        ratio_coordinates = []
+        for output_text in output_texts:
+            try:
+                click_xy = ast.literal_eval(output_text)
+                # [0.73, 0.21]
+                ratio_coordinates.append(RatioCoordinate(x_ratio=float(click_xy[0]), y_ratio=float(click_xy[1])))
+            except (ValueError, SyntaxError, TypeError, IndexError):
+                if strict:
+                    raise
+                # not strict: the caller has another answer to fall back to
+                ratio_coordinates.append(None)
+        return ratio_coordinates
+
+    def _crop_box(self, ratio_coordinate: RatioCoordinate, size):
+        # a square of crop ratio times the short side, moved inside the screen at the edges
+        width, height = size
+        side = max(1, round(min(width, height) * self._crop_ratio))
+        left = min(max(0, round(ratio_coordinate.x_ratio * width - side / 2)), max(0, width - side))
+        top = min(max(0, round(ratio_coordinate.y_ratio * height - side / 2)), max(0, height - side))
+        return left, top, min(width, left + side), min(height, top + side)
+
+    def generate_batch(self, requests) -> list[str]:
+        # requests are (query, screenshot) pairs of different screenshots, used by the model server
+        with self._lock:
+            inputs = self._inference.prepare([self._messages(query, screenshot.image) for query, screenshot in requests])
+            return self._inference.generate(inputs, max_new_tokens=128)
+
+    def _messages(self, query, image: Image.Image):
+        return [
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": LOCATE_PROMPT},
-                    {"type": "image", "image": os.path.join(self._run_path, "records/screencaps", f"{query}.png")},
+                    {"type": "image", "image": image},
                     {"type": "text", "text": query}
                 ],
             }
         ]
 
-        text = self._processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True,
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self._processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-
-        inputs = inputs.to(self._model.device)
-
-        generated_ids = self._model.generate(**inputs, max_new_tokens=128)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
-        output_text = self._processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-
-        click_xy = ast.literal_eval(output_text)
-        # [0.73, 0.21]
-
-        marked_image = self._draw_point(os.path.join(self._run_path, "records/screencaps", f"{query}.png"), click_xy)
-        marked_image.save(os.path.join(self._run_path, "records/screencaps", f"{query}.png"))
-        return RatioCoordinate(x_ratio=click_xy[0], y_ratio=click_xy[1])
-
 class RemoteLocate(Locate):
     def __init__(self, config: Config, run_path):
         super().__init__(config, run_path)
         self.host = config.locate_model_host
+        self.model_repo = config.locate_model_repo
+        self._transport = transport.get_transport(config)
+        self._preprocessor = ImagePreprocessor.from_config(config)
         logging.info("RemoteLocate initialized completely. ")
 
-    def _locate_ratio(self, query) -> RatioCoordinate:
-        base64_image = None
-        image_path = os.path.join(self._run_path, "records/screencaps", f"{query}.png")
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-
+    def payload(self, query, screenshot: Screenshot):
+        # the chat completions request of a query, AsyncLocate sends it over its own transport
         messages = [
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": LOCATE_PROMPT},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "image_url", "image_url": {"url": self._preprocessor.data_url(screenshot)}},
                     {"type": "text", "text": query}
                 ]
             }
         ]
+        return {
+            "model": self.model_repo,
+            "messages": messages
+        }
 
-        response = requests.post(
-            f"{self.host}/v1/chat/completions", 
-            headers={"Content-Type": "application/json"},
-            json={
-                "model": "showlab/ShowUI-2B",
-                "messages": messages
-            }
-        )
-
-        click_xy = ast.literal_eval(response.json()["choices"][0]["message"]["content"])
-        marked_image = self._draw_point(image_path, click_xy)
-        marked_image.save(image_path)
+    def parse(self, response) -> RatioCoordinate:
+        click_xy = ast.literal_eval(response["choices"][0]["message"]["content"])
         return RatioCoordinate(x_ratio=click_xy[0], y_ratio=click_xy[1])
 
-    def _marked_image(self, query, image_path):
-        target_path = os.path.join(self._run_path, "records/screencaps", f"{query}.png")
+    def _locate_ratio(self, query, screenshot: Screenshot) -> RatioCoordinate:
+        return self.parse(self._transport.chat_completions(self.host, self.payload(query, screenshot)))
 
-        try:
-            os.rename(image_path, target_path)
-            return target_path
-        except Exception as e:
-            raise Exception(f"move marked image failed: {str(e)}") from e
\ No newline at end of file
+    def _locate_ratios(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        if len(queries) == 1:
+            return [self._locate_ratio(queries[0], screenshot)]
+        # n parallel requests, the model server batches them together
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            return list(executor.map(tracer.wrap(lambda query: self._locate_ratio(query, screenshot)), queries))
+
+# awaitable locate of the async core, a remote host is requested over the asyncio transport and every other backend runs in the executor
+class AsyncLocate:
+    def __init__(self, locate: Locate, runtime, async_transport: transport.AsyncTransport):
+        self.backend = locate
+        self._runtime = runtime
+        self._transport = async_transport
+        # local models and backends without a host share one limit
+        self._resource = ("model", getattr(locate, "host", "local"))
+
+    async def locate_pixel(self, query, screenshot: Screenshot, device_pixel_config=None):
+        return (await self.locate_many(screenshot, [query], device_pixel_config))[0]
+
+    async def locate_many(self, screenshot: Screenshot, queries, device_pixel_config=None):
+        return await self._runtime.run(self.backend.locate_plan(screenshot, queries, device_pixel_config, self._locate_ratios))
+
+    async def learn(self, screenshot: Screenshot):
+        return await self._runtime.offload(self.backend.learn, screenshot)
+
+    async def _locate_ratios(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        if not isinstance(self.backend, RemoteLocate):
+            return await self._runtime.offload(self.backend._locate_ratios, queries, screenshot, resource=self._resource)
+        return list(await asyncio.gather(*(self._request(query, screenshot) for query in queries)))
+
+    async def _request(self, query, screenshot: Screenshot) -> RatioCoordinate:
+        # the screenshot is encoded in the executor, only the request itself waits on the event loop
+        payload = await self._runtime.offload(self.backend.payload, query, screenshot)
+        async with self._runtime.limit(self._resource):
+            with span("transport.chat_completions", "transport", host=self.backend.host):
+                response = await self._transport.chat_completions(self.backend.host, payload)
+        return self.backend.parse(response)
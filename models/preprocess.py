@@ -0,0 +1,45 @@
+import base64
+from io import BytesIO
+from PIL import Image
+from config import Config
+from mobile.client import Screenshot
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# shrink and compress screenshots before they are sent to a remote model,
+# coordinates are ratios of the image size, so they stay valid after resizing
+class ImagePreprocessor:
+    def __init__(self, max_side=0, image_format="png", quality=85, grayscale=False):
+        if image_format not in MIME_TYPES:
+            raise Exception(f"remote image format is not supported: {image_format}, support: {', '.join(MIME_TYPES)}")
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        self.grayscale = grayscale
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ImagePreprocessor":
+        return cls(config.remote_image_max_side, config.remote_image_format, config.remote_image_quality, config.remote_image_grayscale)
+
+    def data_url(self, screenshot: Screenshot) -> str:
+        key = (self.max_side, self.image_format, self.quality, self.grayscale)
+        # parallel requests on the same screenshot encode it only once
+        return screenshot.encoding(key, lambda screenshot: f"data:{MIME_TYPES[self.image_format]};base64,{self._encode(screenshot)}")
+
+    def _encode(self, screenshot: Screenshot) -> str:
+        image = screenshot.image
+        resize = self.max_side and max(image.size) > self.max_side
+        if not resize and not self.grayscale and self.image_format == "png":
+            return screenshot.base64()
+
+        image = image.convert("L" if self.grayscale else "RGB")
+        if resize:
+            scale = self.max_side / max(image.size)
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        buffer = BytesIO()
+        if self.image_format == "png":
+            image.save(buffer, format="PNG", optimize=False)
+        else:
+            image.save(buffer, format=self.image_format.upper(), quality=self.quality)
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
@@ -0,0 +1,108 @@
+import os
+import json
+import torch
+import logging
+import threading
+from huggingface_hub import snapshot_download
+from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+
+PROCESSOR_REPO = "Qwen/Qwen2-VL-2B-Instruct"
+# keep the folders used by earlier versions, so downloaded models are not fetched again
+LOCAL_FOLDERS = {
+    "showlab/ShowUI-2B": "./showui-2b",
+    "Qwen/Qwen2-VL-2B-Instruct": "./qwen2-vl",
+}
+SNAPSHOT_MANIFEST = ".aitest-snapshot.json"
+# fp32: reference precision, bf16: half the memory, int8: dynamic quantization of the linear layers of the language model
+BACKENDS = ("fp32", "bf16", "int8")
+
+_lock = threading.Lock()
+_models = {}
+_processor = None
+
+# a model loaded once per process, shared by LocalLocate and LocalValidate
+class SharedModel:
+    def __init__(self, repo_id, backend, model, processor):
+        self.repo_id = repo_id
+        self.backend = backend
+        self.model = model
+        self.processor = processor
+        # the model keeps state between forward calls, callers take turns to use it
+        self.lock = threading.Lock()
+
+def local_folder(repo_id):
+    return LOCAL_FOLDERS.get(repo_id, os.path.join(".", repo_id.split("/")[-1].lower()))
+
+def _snapshot_complete(folder):
+    manifest_path = os.path.join(folder, SNAPSHOT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        files = json.load(f)
+    return all(os.path.exists(os.path.join(folder, file)) for file in files)
+
+def ensure_snapshot(repo_id):
+    folder = local_folder(repo_id)
+    if _snapshot_complete(folder):
+        logging.info(f"local snapshot of {repo_id} is complete, path: {folder}")
+        return folder
+
+    try:
+        snapshot_download(repo_id=repo_id, local_dir=folder)
+    except Exception as e:
+        if not os.path.exists(os.path.join(folder, "config.json")):
+            raise Exception(f"download {repo_id} failed: {str(e)}") from e
+        logging.warning(f"download {repo_id} failed, use the existing files in {folder}: {str(e)}")
+        return folder
+
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        files += [os.path.relpath(os.path.join(root, name), folder) for name in names if name != SNAPSHOT_MANIFEST]
+    with open(os.path.join(folder, SNAPSHOT_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(sorted(files), f, indent=2)
+    logging.info(f"downloaded {repo_id} to {folder}")
+    return folder
+
+def load_processor():
+    global _processor
+    with _lock:
+        if _processor is None:
+            try:
+                _processor = AutoProcessor.from_pretrained(PROCESSOR_REPO, local_files_only=True)
+            except OSError:
+                logging.info(f"processor of {PROCESSOR_REPO} is not cached, download it")
+                _processor = AutoProcessor.from_pretrained(PROCESSOR_REPO)
+        return _processor
+
+def set_threads(threads):
+    # 0 keeps the torch default, which is the number of physical cores
+    if threads and threads > 0 and torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+        logging.info(f"torch intra-op threads: {threads}")
+
+def load_shared_model(repo_id, backend="fp32", threads=0) -> SharedModel:
+    if backend not in BACKENDS:
+        raise Exception(f"local model backend is not supported: {backend}, support: {', '.join(BACKENDS)}")
+    set_threads(threads)
+    processor = load_processor()
+    with _lock:
+        if (repo_id, backend) not in _models:
+            folder = ensure_snapshot(repo_id)
+            # safetensors weights are memory mapped, repeated runs load them from the page cache
+            model = Qwen2VLForConditionalGeneration.from_pretrained(
+                folder,
+                torch_dtype=torch.bfloat16 if backend == "bf16" else torch.float32,
+                device_map="cpu",
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+            )
+            if backend == "int8":
+                # the vision tower stays in fp32, it reads the dtype of its pixel values from a linear weight
+                # and a quantized linear has no weight tensor; the language model and lm_head hold most of the weights
+                linear_names = {name for name, module in model.named_modules() if isinstance(module, torch.nn.Linear) and not name.startswith("visual.")}
+                model = torch.ao.quantization.quantize_dynamic(model, linear_names, dtype=torch.qint8)
+            model.eval()
+            _models[(repo_id, backend)] = SharedModel(repo_id, backend, model, processor)
+            logging.info(f"model {repo_id} loaded, backend: {backend}")
+        return _models[(repo_id, backend)]
@@ -0,0 +1,164 @@
+import json
+import time
+import uuid
+import base64
+import logging
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import Config
+from mobile.client import Screenshot
+from models.locate import LOCATE_PROMPT, LocalLocate
+from models.validate import VALIDATE_PROMPT, LocalValidate
+
+# collects concurrent requests into batches, a batch is run when it is full or the oldest request waited max_wait seconds
+class MicroBatcher:
+    def __init__(self, name, handler, max_batch_size=8, max_wait=0.02):
+        self._handler = handler
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, request) -> Future:
+        future = Future()
+        with self._condition:
+            self._pending.append((request, future))
+            self._condition.notify()
+        return future
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = time.monotonic() + self._max_wait
+            while len(self._pending) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self._max_batch_size]
+            del self._pending[:self._max_batch_size]
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            logging.info(f"run a batch of {len(batch)} requests")
+            try:
+                results = self._handler([request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+def _decode_image(url) -> Screenshot:
+    # data:image/png;base64,...
+    if not url.startswith("data:") or "," not in url:
+        raise ValueError("only base64 data urls are supported")
+    return Screenshot(base64.b64decode(url.split(",", 1)[1]))
+
+def _parse_messages(payload):
+    # returns (prompt, screenshot, text) of the single user message sent by RemoteLocate and RemoteValidate
+    texts, screenshot = [], None
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for item in content or []:
+            if item.get("type") == "text":
+                texts.append(item["text"])
+            elif item.get("type") == "image_url":
+                screenshot = _decode_image(item["image_url"]["url"])
+    if screenshot is None or len(texts) != 2:
+        raise ValueError("a prompt, an image and a text are expected")
+    return texts[0], screenshot, texts[1]
+
+# an openai compatible /v1/chat/completions server of the local locate and validate models
+class ModelServer:
+    def __init__(self, config: Config, run_path, max_batch_size=8, max_wait=0.02):
+        self._locate = LocalLocate(config, run_path)
+        self._validate = LocalValidate(config, run_path)
+        self._models = [config.locate_model_repo, config.validate_model_repo]
+        self._locate_batcher = MicroBatcher("locate-batcher", self._locate.generate_batch, max_batch_size, max_wait)
+        self._validate_batcher = MicroBatcher("validate-batcher", self._validate_batch, max_batch_size, max_wait)
+
+    def _validate_batch(self, requests):
+        return ["found" if result else "not found" for result in self._validate.validate_batch(requests)]
+
+    def complete(self, model, prompt, screenshot, text) -> dict:
+        if prompt == LOCATE_PROMPT:
+            future = self._locate_batcher.submit((text, screenshot))
+        elif prompt == VALIDATE_PROMPT:
+            future = self._validate_batcher.submit((screenshot, text))
+        else:
+            raise ValueError("the prompt is neither the locate prompt nor the validate prompt")
+        # blocks until the batch of the request is run
+        content = future.result()
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        }
+
+    def serve(self, host, port):
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        server.daemon_threads = True
+        logging.info(f"model server listening on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def models(self) -> dict:
+        return {"object": "list", "data": [{"id": model, "object": "model"} for model in dict.fromkeys(self._models)]}
+
+def _handler(model_server: ModelServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._reply(200, {"status": "ok"})
+            elif self.path == "/v1/models":
+                self._reply(200, model_server.models())
+            else:
+                self._reply(404, {"error": {"message": f"not found: {self.path}"}})
+
+        def do_POST(self):
+            if self.path != "/v1/chat/completions":
+                self._reply(404, {"error": {"message": f"not found: {self.path}"}})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                prompt, screenshot, text = _parse_messages(payload)
+                if prompt not in (LOCATE_PROMPT, VALIDATE_PROMPT):
+                    raise ValueError("the prompt is neither the locate prompt nor the validate prompt")
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"error": {"message": str(e)}})
+                return
+            try:
+                self._reply(200, model_server.complete(payload.get("model", ""), prompt, screenshot, text))
+            except Exception as e:
+                logging.exception("chat completion failed")
+                self._reply(500, {"error": {"message": str(e)}})
+
+        def _reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
@@ -0,0 +1,163 @@
+import os
+import json
+import weakref
+import hashlib
+import logging
+import threading
+import numpy as np
+from PIL import Image
+from config import Config
+from mobile.client import Screenshot
+from models.locate import Locate, RatioCoordinate
+
+try:
+    import cv2
+except ImportError:
+    # opencv is optional, numpy fft correlation is used without it
+    cv2 = None
+
+# the long side of the screenshot is reduced to this size before matching
+SEARCH_SIDE = 720
+SCALES = (0.8, 0.9, 1.0, 1.1, 1.25)
+
+def _gray(image: Image.Image, scale) -> np.ndarray:
+    image = image.convert("L")
+    if scale != 1.0:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.BILINEAR)
+    return np.asarray(image, dtype=np.float32)
+
+def _match_numpy(image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    # normalized cross correlation, the same as cv2.TM_CCOEFF_NORMED
+    th, tw = template.shape
+    template = template - template.mean()
+    template_norm = np.sqrt((template ** 2).sum())
+    if template_norm == 0:
+        return np.zeros((image.shape[0] - th + 1, image.shape[1] - tw + 1), dtype=np.float32)
+
+    shape = (image.shape[0] + th - 1, image.shape[1] + tw - 1)
+    correlation = np.fft.irfft2(np.fft.rfft2(image, shape) * np.fft.rfft2(template[::-1, ::-1], shape), shape)
+    correlation = correlation[th - 1:image.shape[0], tw - 1:image.shape[1]]
+
+    # sums of every template sized window from integral images
+    integral = np.pad(image.astype(np.float64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    integral_square = np.pad((image.astype(np.float64) ** 2).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    window_sum = integral[th:, tw:] - integral[:-th, tw:] - integral[th:, :-tw] + integral[:-th, :-tw]
+    window_square = integral_square[th:, tw:] - integral_square[:-th, tw:] - integral_square[th:, :-tw] + integral_square[:-th, :-tw]
+    window_norm = np.sqrt(np.maximum(window_square - window_sum ** 2 / (th * tw), 0))
+
+    scores = np.zeros_like(correlation, dtype=np.float32)
+    valid = window_norm > 1e-3
+    scores[valid] = correlation[valid] / (window_norm[valid] * template_norm)
+    return scores
+
+def _match(image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    if cv2 is not None:
+        return cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    return _match_numpy(image, template)
+
+# crops of located elements, learned from earlier locates and keyed by query
+class TemplateStore:
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(path, "templates.json")
+        # query -> {"file": crop file name, "offset": [x, y] of the located point in the crop, scaled from 0 to 1}
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+
+    def get(self, query):
+        with self._lock:
+            entry = self._index.get(query)
+        if entry is None:
+            return None, None
+        image_path = os.path.join(self._path, entry["file"])
+        if not os.path.exists(image_path):
+            return None, None
+        return Image.open(image_path), entry["offset"]
+
+    def put(self, query, crop: Image.Image, offset):
+        file_name = f"{hashlib.sha1(query.encode('utf-8')).hexdigest()}.png"
+        with self._lock:
+            os.makedirs(self._path, exist_ok=True)
+            crop.save(os.path.join(self._path, file_name))
+            self._index[query] = {"file": file_name, "offset": offset}
+            with open(self._index_path, "w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False, indent=2)
+
+# find elements by matching the crops of earlier locates, the fallback model is only used when nothing matches
+class TemplateLocate(Locate):
+    def __init__(self, config: Config, run_path, fallback: Locate):
+        # the cache is checked in front of the templates, the fallback is only asked by _locate_ratios, which never reads it
+        super().__init__(config, run_path, fallback._cache)
+        fallback._cache = None
+        self._fallback = fallback
+        self._threshold = config.template_threshold
+        self._size = config.template_size
+        template_path = config.template_path if os.path.isabs(config.template_path) else os.path.join(run_path, config.template_path)
+        self._store = TemplateStore(template_path)
+        # screenshot -> (query, ratio coordinate) located by the fallback on it, learned once its step passes,
+        # a thrown away prefetch or a failed step is forgotten with its screenshot
+        self._unlearned = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        logging.info(f"TemplateLocate initialized completely, opencv: {cv2 is not None}")
+
+    def _locate_ratio(self, query, screenshot: Screenshot) -> RatioCoordinate:
+        return self._locate_ratios([query], screenshot)[0]
+
+    def _locate_ratios(self, queries, screenshot: Screenshot) -> list[RatioCoordinate]:
+        ratio_coordinates = [self._match(query, screenshot) for query in queries]
+        missing = [index for index, ratio_coordinate in enumerate(ratio_coordinates) if ratio_coordinate is None]
+        if missing:
+            located = self._fallback._locate_ratios([queries[index] for index in missing], screenshot)
+            for index, ratio_coordinate in zip(missing, located):
+                ratio_coordinates[index] = ratio_coordinate
+            with self._lock:
+                self._unlearned.setdefault(screenshot, []).extend((queries[index], ratio_coordinates[index]) for index in missing)
+        return ratio_coordinates
+
+    def learn(self, screenshot: Screenshot):
+        super().learn(screenshot)
+        with self._lock:
+            located = self._unlearned.pop(screenshot, [])
+        for query, ratio_coordinate in located:
+            self._learn(query, screenshot, ratio_coordinate)
+
+    def _match(self, query, screenshot: Screenshot):
+        template, offset = self._store.get(query)
+        if template is None:
+            return None
+        image = screenshot.image
+        scale = min(1.0, SEARCH_SIDE / max(image.size))
+        search = _gray(image, scale)
+
+        best_score, best_location, best_size = -1.0, None, None
+        for template_scale in SCALES:
+            pattern = _gray(template, scale * template_scale)
+            if pattern.shape[0] < 4 or pattern.shape[1] < 4 or pattern.shape[0] > search.shape[0] or pattern.shape[1] > search.shape[1]:
+                continue
+            scores = _match(search, pattern)
+            y, x = np.unravel_index(np.argmax(scores), scores.shape)
+            if scores[y, x] > best_score:
+                best_score, best_location, best_size = float(scores[y, x]), (x, y), (pattern.shape[1], pattern.shape[0])
+
+        if best_location is None or best_score < self._threshold:
+            logging.info(f"template of 【{query}】 not matched, best score: {best_score:.3f}")
+            return None
+        logging.info(f"template of 【{query}】 matched, score: {best_score:.3f}")
+        x = (best_location[0] + offset[0] * best_size[0]) / search.shape[1]
+        y = (best_location[1] + offset[1] * best_size[1]) / search.shape[0]
+        return RatioCoordinate(x_ratio=x, y_ratio=y)
+
+    def _learn(self, query, screenshot: Screenshot, ratio_coordinate: RatioCoordinate):
+        # a square crop around the located point, clipped at the screen edges
+        image = screenshot.image
+        half = max(8, round(image.width * self._size / 2))
+        x, y = ratio_coordinate.x_ratio * image.width, ratio_coordinate.y_ratio * image.height
+        left, top = max(0, round(x - half)), max(0, round(y - half))
+        right, bottom = min(image.width, round(x + half)), min(image.height, round(y + half))
+        if right - left < 8 or bottom - top < 8:
+            return
+        crop = image.crop((left, top, right, bottom))
+        self._store.put(query, crop, [(x - left) / (right - left), (y - top) / (bottom - top)])
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+from tracing import span
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# keep-alive connection pool to the /v1/chat/completions hosts, shared by all remote models of the process
+class Transport:
+    def __init__(self, timeout=60.0, retries=3, backoff=0.5, pool_size=10):
+        self.timeout = timeout
+        self._session = requests.Session()
+        # chat completions have no side effects, so POST requests are retried as well
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS, allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def chat_completions(self, host, payload) -> dict:
+        with span("transport.chat_completions", "transport", host=host):
+            response = self._session.post(f"{host}/v1/chat/completions", json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+
+    def close(self):
+        self._session.close()
+
+# the asyncio variant, many sessions of one event loop multiplex their requests over one pool
+class AsyncTransport:
+    def __init__(self, timeout=60.0, retries=3, backoff=0.5, pool_size=10):
+        self.timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def chat_completions(self, host, payload) -> dict:
+        attempt = 0
+        while True:
+            try:
+                response = await self._client.post(f"{host}/v1/chat/completions", json=payload)
+                if response.status_code not in RETRY_STATUS or attempt >= self._retries:
+                    response.raise_for_status()
+                    return response.json()
+                logging.info(f"model request failed with status {response.status_code}, retry")
+            except httpx.TransportError as e:
+                if attempt >= self._retries:
+                    raise
+                logging.info(f"model request failed: {str(e)}, retry")
+            await asyncio.sleep(self._backoff * (2 ** attempt))
+            attempt += 1
+
+    async def close(self):
+        await self._client.aclose()
+
+_lock = threading.Lock()
+_transport = None
+
+def get_transport(config: Config) -> Transport:
+    global _transport
+    with _lock:
+        if _transport is None:
+            _transport = Transport(config.model_request_timeout, config.model_request_retries, config.model_request_backoff, config.model_pool_size)
+        return _transport
+
+def create_async_transport(config: Config) -> AsyncTransport:
+    # the httpx client is bound to the event loop it is used in, create one per loop
+    return AsyncTransport(config.model_request_timeout, config.model_request_retries, config.model_request_backoff, config.model_pool_size)
@@ -1,24 +1,31 @@
-import base64
 from config import Config
-from transformers import AutoProcessor
-from huggingface_hub import hf_hub_download, list_repo_files
-from qwen_vl_utils import process_vision_info
-from transformers import Qwen2VLForConditionalGeneration
-import os
+from mobile.client import Screenshot
+from models import transport, workers
+from models.preprocess import ImagePreprocessor
+from tracing import span
 import logging  
-import torch
-import requests
 
-MODEL_REPO = "Qwen/Qwen2-VL-2B-Instruct"
-DESTINATION_FOLDER = "./qwen2-vl"
 VALIDATE_PROMPT = "please check the screenshot and tell me whether you can find the following element or not. if you can find the element in the screenshot, please directly answer 'found'. if you can't find it, answer 'not found'."
 
+# the result of a validation, it is truthy when the validation passed
+class ValidateResult:
+    def __init__(self, passed, confidence):
+        self.passed = passed
+        # the probability of "found", scaled from 0 to 1
+        self.confidence = confidence
+
+    def __bool__(self):
+        return self.passed
+
+    def __str__(self):
+        return f"ValidateResult(passed={self.passed}, confidence={self.confidence:.3f})"
+
 class Validate:
     def __init__(self, config: Config, run_path):
         self._run_path = run_path
         self._config = config
 
-    def validate(self, query, validation):
+    def validate(self, screenshot: Screenshot, validation) -> ValidateResult:
         pass
     
 class LocalValidate(Validate):
@@ -26,91 +33,123 @@ class LocalValidate(Validate):
         super().__init__(config, run_path)
         logging.info("LocalValidate initialized completely. ")
 
-        os.makedirs(DESTINATION_FOLDER, exist_ok=True)
-        files = list_repo_files(repo_id=MODEL_REPO)
-        for file in files:
-            file_path = hf_hub_download(repo_id=MODEL_REPO, filename=file, local_dir=DESTINATION_FOLDER)
-            print(f"Downloaded {file} to {file_path}")
-
-        # load pretrained model
-        model = Qwen2VLForConditionalGeneration.from_pretrained(
-            DESTINATION_FOLDER,
-            torch_dtype=torch.float32,
-            device_map="cpu",
-            low_cpu_mem_usage=True,
-        )
-
-        # load tokenizer and processor
-        processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-2B-Instruct")
-        self._model = model
-        self._processor = processor
-
-    def validate(self, query, validation) -> bool:
-        messages = [
+        # the model runs in worker processes, they are shared by all device threads and loaded only once
+        self._workers = None
+        if config.local_model_workers > 0 or config.local_model_worker_address:
+            self._workers = workers.get_workers(config, run_path)
+            return
+
+        # torch and transformers are only imported in local mode, remote runners do not install them
+        from models import registry
+        from models.inference import PrefixInference
+
+        # the model and processor are shared with LocalLocate when both use the same repo
+        shared_model = registry.load_shared_model(config.validate_model_repo, config.local_model_backend, config.local_model_threads)
+        self._model = shared_model.model
+        self._processor = shared_model.processor
+        self._lock = shared_model.lock
+        # the kv cache of VALIDATE_PROMPT is computed once and reused by every validation
+        self._inference = PrefixInference(self._model, self._processor)
+        self._mode = config.validate_mode
+        self._threshold = config.validate_threshold
+        # first tokens of the two possible answers, "found" and "not found"
+        tokenizer = self._processor.tokenizer
+        self._found_ids = [tokenizer.encode(word, add_special_tokens=False)[0] for word in ("found", "Found")]
+        self._not_found_ids = [tokenizer.encode(word, add_special_tokens=False)[0] for word in ("not", "Not")]
+
+    def validate(self, screenshot: Screenshot, validation) -> ValidateResult:
+        if self._workers is not None:
+            result = ValidateResult(*self._workers.validate(screenshot, validation))
+            logging.info(f"The validation result is: {result}")
+            return result
+        return self.validate_batch([(screenshot, validation)])[0]
+
+    def validate_batch(self, requests) -> list[ValidateResult]:
+        # requests are (screenshot, validation) pairs, the model server validates concurrent requests in one batch
+        with self._lock:
+            return self._validate_locked(requests)
+
+    def _validate_locked(self, requests) -> list[ValidateResult]:
+        messages_list = [[
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": VALIDATE_PROMPT},
-                    {"type": "image", "image": os.path.join(self._run_path, "records/screencaps", f"{query}_validation.png")},
+                    {"type": "image", "image": screenshot.image},
                     {"type": "text", "text": validation}
                 ],
             }
-        ]
-        text = self._processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True,
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self._processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to(self._model.device)
-        generated_ids = self._model.generate(**inputs, max_new_tokens=128)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+        ] for screenshot, validation in requests]
+        inputs = self._inference.prepare(messages_list)
+        if self._mode == "score":
+            return self._score(inputs)
 
-        output_text = self._processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0].lower().strip()
-        logging.info(f"The validation result is: {output_text}")
-        return output_text == "found"
+        results = []
+        for output_text in self._inference.generate(inputs, max_new_tokens=128):
+            output_text = output_text.lower().strip()
+            logging.info(f"The validation result is: {output_text}")
+            passed = output_text == "found"
+            results.append(ValidateResult(passed, 1.0 if passed else 0.0))
+        return results
+
+    def _score(self, inputs) -> list[ValidateResult]:
+        # a single forward pass, the answer is decided by the first token of "found" and "not found"
+        results = []
+        for confidence in self._inference.answer_confidences(inputs, self._found_ids, self._not_found_ids):
+            result = ValidateResult(confidence >= self._threshold, confidence)
+            logging.info(f"The validation result is: {result}")
+            results.append(result)
+        return results
     
 class RemoteValidate(Validate):
     def __init__(self, config: Config, run_path):
         super().__init__(config, run_path)
         self.host = config.validate_model_host
+        self.model_repo = config.validate_model_repo
+        self._transport = transport.get_transport(config)
+        self._preprocessor = ImagePreprocessor.from_config(config)
         logging.info("RemoteValidate initialized completely. ")
 
-    def validate(self, query, validation) -> bool:
-        base64_image = None
-        image_path = os.path.join(self._run_path, "records/screencaps", f"{query}_validation.png")
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-
+    def payload(self, screenshot: Screenshot, validation):
+        # the chat completions request of a validation, AsyncValidate sends it over its own transport
         messages = [
             {
                 "role": "user", 
                 "content": [
                     {"type": "text", "text": VALIDATE_PROMPT},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "image_url", "image_url": {"url": self._preprocessor.data_url(screenshot)}},
                     {"type": "text", "text": validation}
                 ]
             }
         ]
+        return {
+            "model": self.model_repo,
+            "messages": messages
+        }
 
-        response = requests.post(
-            f"{self.host}/v1/chat/completions",
-            headers={"Content-Type": "application/json"},
-            json={
-                "model": "Qwen/Qwen2-VL-2B-Instruct",
-                "messages": messages
-            }
-        )
-
-        output_text = response.json()["choices"][0]["message"]["content"].lower().strip()
+    def parse(self, response) -> ValidateResult:
+        output_text = response["choices"][0]["message"]["content"].lower().strip()
         logging.info(f"The validation result is: {output_text}")
-        return output_text == "found"
+        passed = output_text == "found"
+        return ValidateResult(passed, 1.0 if passed else 0.0)
+
+    def validate(self, screenshot: Screenshot, validation) -> ValidateResult:
+        return self.parse(self._transport.chat_completions(self.host, self.payload(screenshot, validation)))
+
+# awaitable validate of the async core, a remote host is requested over the asyncio transport and a local model runs in the executor
+class AsyncValidate:
+    def __init__(self, validate: Validate, runtime, async_transport: transport.AsyncTransport):
+        self.backend = validate
+        self._runtime = runtime
+        self._transport = async_transport
+        # shared with AsyncLocate when both use the same host or local models
+        self._resource = ("model", getattr(validate, "host", "local"))
+
+    async def validate(self, screenshot: Screenshot, validation) -> ValidateResult:
+        if not isinstance(self.backend, RemoteValidate):
+            return await self._runtime.offload(self.backend.validate, screenshot, validation, resource=self._resource)
+        payload = await self._runtime.offload(self.backend.payload, screenshot, validation)
+        async with self._runtime.limit(self._resource):
+            with span("transport.chat_completions", "transport", host=self.backend.host):
+                response = await self._transport.chat_completions(self.backend.host, payload)
+        return self.backend.parse(response)
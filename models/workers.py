@@ -0,0 +1,334 @@
+import os
+import logging
+import secrets
+import argparse
+import itertools
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import Future
+from multiprocessing import connection, resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+from PIL import Image
+import config
+from config import Config
+from mobile.client import Screenshot
+
+# the secret of a pool shared by several engines, its server unpickles what connected clients send
+AUTHKEY_ENV = "AITEST_MODEL_WORKER_AUTHKEY"
+# pixels are passed as raw bytes of these modes, other modes are converted to RGB first
+SHARED_MODES = ("RGB", "RGBA", "L")
+
+def _attach(name, untrack) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name)
+    if untrack:
+        # the segment is owned by an engine of another process tree, the resource tracker of the pool must not unlink it
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+def _read_image(name, mode, size, untrack) -> Image.Image:
+    segment = _attach(name, untrack)
+    try:
+        view = segment.buf[:size[0] * size[1] * len(mode)]
+        try:
+            return Image.frombytes(mode, size, view)
+        finally:
+            view.release()
+    finally:
+        segment.close()
+
+def _worker_main(conf: Config, run_path, pipe, untrack):
+    # imported here, the models are loaded in the worker and never in the pool process
+    from models.locate import LocalLocate
+    from models.validate import LocalValidate
+
+    conf.local_model_workers = 0
+    conf.local_model_worker_address = ""
+    # the models are loaded before the first task, downloading and loading them does not count against the task timeout
+    try:
+        locate = LocalLocate(conf, run_path) if conf.locate_model_type == "local" else None
+        validate = LocalValidate(conf, run_path) if conf.validate_model_type == "local" else None
+    except Exception as e:
+        logging.exception("loading the models failed")
+        pipe.send((None, None, f"{type(e).__name__}: {str(e)}"))
+        return
+    # a message without task id tells the pool the worker is ready
+    pipe.send((None, None, None))
+    while True:
+        try:
+            task = pipe.recv()
+        except EOFError:
+            # the pool is gone
+            return
+        if task is None:
+            return
+        task_id, kind, name, mode, size, argument = task
+        try:
+            screenshot = Screenshot.from_image(_read_image(name, mode, size, untrack))
+            if kind == "locate":
+                locate = locate or LocalLocate(conf, run_path)
+                result = [(ratio.x_ratio, ratio.y_ratio) for ratio in locate._locate_ratios(argument, screenshot)]
+            else:
+                validate = validate or LocalValidate(conf, run_path)
+                validate_result = validate.validate(screenshot, argument)
+                result = (validate_result.passed, validate_result.confidence)
+            pipe.send((task_id, result, None))
+        except Exception as e:
+            logging.exception(f"{kind} task failed")
+            pipe.send((task_id, None, f"{type(e).__name__}: {str(e)}"))
+
+# a worker process, the pipe carries its tasks and results, task id is the task it runs or None when idle,
+# no task is sent before the worker has loaded its models
+class _Worker:
+    def __init__(self, process, pipe):
+        self.process = process
+        self.pipe = pipe
+        self.ready = False
+        self.task_id = None
+
+# a task of the pool, started is set once a ready worker takes it, the timeout counts from then
+class _Task:
+    def __init__(self, message):
+        self.message = message
+        self.future = Future()
+        self.started = threading.Event()
+
+# long-lived processes that hold the local models, tasks are dispatched to whichever worker is free
+# every worker has its own pipe, so a worker that dies, e.g. killed out of memory, fails only its own task and is started again
+class WorkerPool:
+    def __init__(self, conf: Config, run_path, size=1, untrack=False, timeout=0.0):
+        # torch is not fork safe, workers start from a fresh interpreter
+        self._context = multiprocessing.get_context("spawn")
+        self._args = (conf, run_path)
+        self._untrack = untrack
+        # seconds a task may take in a worker, 0 waits forever
+        self._timeout = timeout
+        # task id -> task, of the pending and the running tasks
+        self._tasks = {}
+        # ids of the tasks not sent to a worker yet
+        self._pending = collections.deque()
+        # the error of a worker that could not load the models, the pool fails every task with it
+        self._error = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = [self._start(index) for index in range(max(1, size))]
+        threading.Thread(target=self._dispatch, name="model-worker-results", daemon=True).start()
+        logging.info(f"model worker pool started, workers: {len(self._workers)}")
+
+    def _start(self, index):
+        pipe, worker_pipe = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(*self._args, worker_pipe, self._untrack), name=f"model-worker-{index}", daemon=True)
+        process.start()
+        worker_pipe.close()
+        return _Worker(process, pipe)
+
+    def _assign(self):
+        # called with the lock held, pending tasks go to idle workers
+        for worker in self._workers:
+            while worker.ready and worker.task_id is None and self._pending:
+                task_id = self._pending.popleft()
+                task = self._tasks[task_id]
+                try:
+                    worker.pipe.send(task.message)
+                except OSError:
+                    # the worker is dead, the dispatcher starts it again and it takes the task then
+                    self._pending.appendleft(task_id)
+                    break
+                worker.task_id = task_id
+                task.started.set()
+
+    def _dispatch(self):
+        while not self._closed:
+            with self._lock:
+                workers = list(self._workers)
+            ready = connection.wait([worker.pipe for worker in workers] + [worker.process.sentinel for worker in workers])
+            # results first, a worker may send its result and exit right after
+            for worker in workers:
+                if worker.pipe in ready:
+                    self._receive(worker)
+            for worker in workers:
+                if worker.process.sentinel in ready:
+                    self._restart(worker)
+
+    def _receive(self, worker: _Worker):
+        try:
+            task_id, result, error = worker.pipe.recv()
+        except (EOFError, OSError):
+            # the worker died, its sentinel is ready as well
+            return
+        if task_id is None:
+            self._ready(worker, error)
+            return
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            worker.task_id = None
+            self._assign()
+        # the task may have timed out already
+        if task is None:
+            return
+        if error is not None:
+            task.future.set_exception(Exception(error))
+        else:
+            task.future.set_result(result)
+
+    def _ready(self, worker: _Worker, error):
+        if error is None:
+            logging.info(f"model worker {worker.process.name} is ready")
+            with self._lock:
+                worker.ready = True
+                self._assign()
+            return
+        # loading again would fail the same way, the pool stops and fails its tasks
+        logging.error(f"model worker {worker.process.name} failed to load the models: {error}")
+        with self._lock:
+            self._error = error
+            self._closed = True
+            tasks = list(self._tasks.values())
+            self._tasks.clear()
+            self._pending.clear()
+        for task in tasks:
+            task.future.set_exception(Exception(f"model worker failed to load the models: {error}"))
+            task.started.set()
+
+    def _restart(self, worker: _Worker):
+        # the sentinel is ready before the exit code is collected
+        worker.process.join(timeout=1)
+        with self._lock:
+            if self._closed or worker not in self._workers:
+                return
+            task = self._tasks.pop(worker.task_id, None) if worker.task_id is not None else None
+            worker.pipe.close()
+            index = self._workers.index(worker)
+            self._workers[index] = self._start(index)
+            self._assign()
+        logging.error(f"model worker {worker.process.name} exited with code {worker.process.exitcode}, start it again")
+        if task is not None:
+            task.future.set_exception(Exception(f"model worker {worker.process.name} died with exit code {worker.process.exitcode}, it may be out of memory"))
+
+    def run(self, kind, name, mode, size, argument):
+        with self._lock:
+            if self._error is not None:
+                raise Exception(f"model worker failed to load the models: {self._error}")
+            task_id = next(self._ids)
+            task = self._tasks[task_id] = _Task((task_id, kind, name, mode, tuple(size), argument))
+            self._pending.append(task_id)
+            self._assign()
+        # waits without a limit while the workers load their models or run earlier tasks
+        task.started.wait()
+        try:
+            return task.future.result(timeout=self._timeout or None)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self._tasks.pop(task_id, None)
+                hung = [worker for worker in self._workers if worker.task_id == task_id]
+            # a hung worker would never take another task, the dispatcher starts it again
+            for worker in hung:
+                worker.process.terminate()
+            raise Exception(f"{kind} task timed out after {self._timeout}s in the model worker pool")
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.pipe.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=10)
+
+class PoolManager(BaseManager):
+    pass
+
+_pool = None
+
+def _create_pool(conf: Config, run_path, size, untrack=False):
+    global _pool
+    _pool = WorkerPool(conf, run_path, size, untrack, conf.local_model_worker_timeout)
+
+def _get_pool():
+    return _pool
+
+PoolManager.register("pool", callable=_get_pool)
+
+def shared_authkey():
+    key = os.environ.get(AUTHKEY_ENV, "")
+    if not key:
+        raise Exception(f"{AUTHKEY_ENV} is not set, a shared model worker pool and its engines need the same secret key")
+    return key.encode("utf-8")
+
+def _address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+# the engine side of the pool, screenshots are handed over in shared memory instead of being pickled
+class Workers:
+    def __init__(self, conf: Config, run_path):
+        if conf.local_model_worker_address:
+            self._manager = PoolManager(address=_address(conf.local_model_worker_address), authkey=shared_authkey())
+            self._manager.connect()
+            logging.info(f"connected to the model worker pool at {conf.local_model_worker_address}")
+        else:
+            # a pool of this engine only, its key is never known outside of it
+            self._manager = PoolManager(authkey=secrets.token_bytes(32), ctx=multiprocessing.get_context("spawn"))
+            self._manager.start(_create_pool, (conf, run_path, conf.local_model_workers))
+        self._local = threading.local()
+
+    def _pool(self):
+        # proxies are not thread safe, every device thread has its own
+        if not hasattr(self._local, "pool"):
+            self._local.pool = self._manager.pool()
+        return self._local.pool
+
+    def _run(self, kind, screenshot: Screenshot, argument):
+        image = screenshot.image
+        if image.mode not in SHARED_MODES:
+            image = image.convert("RGB")
+        data = image.tobytes()
+        segment = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            segment.buf[:len(data)] = data
+            return self._pool().run(kind, segment.name, image.mode, image.size, argument)
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def locate(self, queries, screenshot: Screenshot):
+        return self._run("locate", screenshot, list(queries))
+
+    def validate(self, screenshot: Screenshot, validation):
+        return self._run("validate", screenshot, validation)
+
+_lock = threading.Lock()
+_workers = None
+
+def get_workers(conf: Config, run_path) -> Workers:
+    global _workers
+    with _lock:
+        if _workers is None:
+            _workers = Workers(conf, run_path)
+        return _workers
+
+if __name__ == "__main__":
+    # AITEST_MODEL_WORKER_AUTHKEY=... python -m models.workers --workers 2 --port 6100,
+    # then set local-model-worker-address: "127.0.0.1:6100" and the same AITEST_MODEL_WORKER_AUTHKEY for the engines
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(processName)s] %(message)s')
+    parser = argparse.ArgumentParser(description='Pool of model worker processes shared by several engines on one host', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--config-file', type=str, default='config.yml', metavar='', help='\nConfiguration file path, default: ./config.yml')
+    parser.add_argument('--workers', type=int, default=1, metavar='', help='\nNumber of worker processes, every worker loads its own models, default: 1')
+    parser.add_argument('--host', type=str, default='127.0.0.1', metavar='', help='\nListen address, default: 127.0.0.1')
+    parser.add_argument('--port', type=int, default=6100, metavar='', help='\nListen port, default: 6100')
+    args = parser.parse_args()
+
+    # checked before the models are loaded, the pool does not start without a key
+    authkey = shared_authkey()
+    run_path = os.getcwd()
+    conf = config.load_config(args.config_file if os.path.isabs(args.config_file) else os.path.join(run_path, args.config_file))
+    # engines connect from their own process trees, they share no resource tracker with the workers
+    _create_pool(conf, run_path, args.workers, untrack=True)
+    server = PoolManager(address=(args.host, args.port), authkey=authkey).get_server()
+    logging.info(f"model worker pool listening on {args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,59 @@
+import time
+import contextvars
+
+# a plan is a generator of the steps of an operation that both the blocking engine and the async core run,
+# it yields every call that blocks and gets its result back, so the two differ only in how the calls are made:
+# run makes them in place, core.aio.Runtime.run awaits them on the event loop.
+# a plan yields the operations below, or the return value of a method of the client, locate or validate it was
+# given, that is the result itself for the blocking ones and an awaitable for the async wrappers
+
+# a blocking function call, the async core runs it in its executor
+class Offload:
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+class Sleep:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+# starts another plan in the background, the yield returns its handle for Join and Cancel
+class Spawn:
+    def __init__(self, plan):
+        self.plan = plan
+
+# waits for a spawned plan, the yield returns its result or raises its error
+class Join:
+    def __init__(self, handle):
+        self.handle = handle
+
+# gives up a spawned plan, its result and error are dropped
+class Cancel:
+    def __init__(self, handle):
+        self.handle = handle
+
+def run(plan, executor=None):
+    # runs a plan in the calling thread, a spawned plan runs in the executor under the context of the caller
+    result, error = None, None
+    while True:
+        try:
+            operation = plan.send(result) if error is None else plan.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            if isinstance(operation, Offload):
+                result = operation.fn(*operation.args)
+            elif isinstance(operation, Sleep):
+                time.sleep(operation.seconds)
+            elif isinstance(operation, Spawn):
+                result = executor.submit(contextvars.copy_context().run, run, operation.plan, executor)
+            elif isinstance(operation, Join):
+                result = operation.handle.result()
+            elif isinstance(operation, Cancel):
+                operation.handle.cancel()
+            else:
+                # a blocking method was called by the plan itself, this is its result
+                result = operation
+        except Exception as e:
+            error = e
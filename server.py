@@ -0,0 +1,24 @@
+import os
+import logging
+import argparse
+import config
+from models.server import ModelServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='OpenAI compatible server of the local locate and validate models', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--config-file', type=str, metavar='', help='\nConfiguration file path, default: ./config.yml')
+    parser.add_argument('--host', type=str, default='0.0.0.0', metavar='', help='\nListen address, default: 0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000, metavar='', help='\nListen port, default: 8000')
+    parser.add_argument('--max-batch-size', type=int, default=8, metavar='', help='\nMost requests run in one batch, default: 8')
+    parser.add_argument('--max-wait-ms', type=float, default=20, metavar='', help='\nLongest wait for a batch to fill up in milliseconds, default: 20')
+    args = parser.parse_args()
+
+    run_path = os.getcwd()
+    config_file = args.config_file or "config.yml"
+    conf = config.load_config(config_file if os.path.isabs(config_file) else os.path.join(run_path, config_file))
+    # the server batches requests itself, the models run in the server process
+    conf.local_model_workers = 0
+    conf.local_model_worker_address = ""
+    ModelServer(conf, run_path, args.max_batch_size, args.max_wait_ms / 1000).serve(args.host, args.port)
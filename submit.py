@@ -0,0 +1,60 @@
+import os
+import sys
+import argparse
+import config
+from core.daemon import submit
+
+def _print(event):
+    if event["type"] == "step":
+        status = "passed" if event["passed"] else f"failed {event['error'] or ''}".strip()
+        device = f"[{event['device']}] " if event["device"] else ""
+        print(f"{device}{event['file']} > {event['case']} > step {event['index'] + 1}: {status}, {event['step']}")
+    elif event["type"] == "case":
+        device = f"[{event['device']}] " if event["device"] else ""
+        print(f"{device}{event['file']} > {event['name']}: {'passed' if event['passed'] else 'failed'} in {event['duration']:.1f}s")
+    elif event["type"] == "summary":
+        print(f"summary: total {event['total']}, passed {event['passed']}, failed {event['failed']}, duration {event['duration']:.1f}s")
+    elif event["type"] == "queued":
+        print("the daemon is running other cases, waiting")
+    elif event["type"] == "health":
+        print("busy" if event["busy"] else f"healthy: {event['clients']}")
+    elif event["type"] == "error":
+        print(f"error: {event['error']}")
+    else:
+        print(event["type"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Submit cases to a running `python aitest.py --daemon`', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('case_path', type=str, nargs='?', help='\nCase file or directory path, default: ./cases/')
+    parser.add_argument('--config-file', type=str, default='config.yml', metavar='', help='\nConfiguration file path, default: ./config.yml')
+    parser.add_argument('--address', type=str, metavar='', help='\nDaemon address, default: daemon-address of the configuration file')
+    parser.add_argument('--connect-timeout', type=float, default=0, metavar='', help='\nSeconds to wait for the daemon to start, default: 0')
+    parser.add_argument('--health', action='store_true', help='\nCheck the device sessions of the daemon, lost sessions are reconnected')
+    parser.add_argument('--stop', action='store_true', help='\nStop the daemon')
+    args = parser.parse_args()
+
+    address = args.address
+    if address is None:
+        address = config.load_config(os.path.abspath(args.config_file)).daemon_address
+
+    if args.stop:
+        request = {"command": "stop"}
+    elif args.health:
+        request = {"command": "health"}
+    else:
+        # the daemon may run in another directory, send an absolute path
+        request = {"command": "run", "case_path": os.path.abspath(args.case_path or "cases")}
+
+    passed = False
+    try:
+        for event in submit(address, request, args.connect_timeout):
+            _print(event)
+            if event["type"] == "summary":
+                passed = event["failed"] == 0
+            elif event["type"] == "health":
+                passed = event["busy"] or all(event["clients"].values())
+            elif event["type"] == "stopped":
+                passed = True
+    except OSError as e:
+        print(f"connect to the daemon at {address} failed: {str(e)}")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,142 @@
+import os
+import json
+import math
+import time
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# a finished span, times are seconds from time.perf_counter
+class Span:
+    def __init__(self, name, category, start, duration, thread_id, thread_name, case, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.duration = duration
+        self.thread_id = thread_id
+        self.thread_name = thread_name
+        self.case = case
+        self.args = args
+
+def percentile(durations, q):
+    # nearest rank on sorted durations
+    index = max(0, min(len(durations) - 1, math.ceil(q / 100 * len(durations)) - 1))
+    return durations[index]
+
+# collects spans of a run in memory, they are aggregated per case and per suite and exported as a chrome trace
+class Tracer:
+    def __init__(self):
+        self.enabled = True
+        self._spans = []
+        self._lock = threading.Lock()
+        # a context variable follows asyncio tasks as well as threads
+        self._case = contextvars.ContextVar("trace_case", default=None)
+
+    def reset(self):
+        with self._lock:
+            self._spans = []
+
+    def current_case(self):
+        return self._case.get()
+
+    @contextmanager
+    def case(self, key):
+        # spans of this thread are counted into the aggregates of the case
+        token = self._case.set(key)
+        try:
+            yield
+        finally:
+            self._case.reset(token)
+
+    def wrap(self, fn):
+        # runs fn in another thread under the case of the caller
+        key = self.current_case()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.case(key):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def span(self, name, category="engine", **args):
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, category, args)
+
+    @contextmanager
+    def _span(self, name, category, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            thread = threading.current_thread()
+            span = Span(name, category, start, duration, thread.ident, thread.name, self.current_case(), args)
+            with self._lock:
+                self._spans.append(span)
+
+    def traced(self, category, name=None):
+        # decorator of methods, the span is named category.method unless a name is given
+        def decorator(fn):
+            span_name = name or f"{category}.{fn.__name__}"
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, category):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def aggregate(self, case=None):
+        # span name -> count, total, p50, p95 and max in seconds, of one case or of the whole suite
+        with self._lock:
+            spans = [span for span in self._spans if case is None or span.case == case]
+        durations = {}
+        for span in spans:
+            durations.setdefault(span.name, []).append(span.duration)
+        phases = {}
+        for name, values in sorted(durations.items()):
+            values.sort()
+            phases[name] = {
+                "count": len(values),
+                "total": round(sum(values), 4),
+                "p50": round(percentile(values, 50), 4),
+                "p95": round(percentile(values, 95), 4),
+                "max": round(values[-1], 4),
+            }
+        return phases
+
+    def export_chrome(self, path):
+        # chrome://tracing and https://ui.perfetto.dev load this json
+        with self._lock:
+            spans = list(self._spans)
+        pid = os.getpid()
+        origin = min((span.start for span in spans), default=0.0)
+        events = []
+        threads = {}
+        for span in spans:
+            threads[span.thread_id] = span.thread_name
+            args = dict(span.args)
+            if span.case is not None:
+                args["case"] = span.case
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": round((span.start - origin) * 1e6, 1),
+                "dur": round(span.duration * 1e6, 1),
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+        for thread_id, thread_name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced